@@ -2,9 +2,23 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+import io
 import os
+import math
+import re
+import sys
 import json
-from typing import List, Dict, Any, Optional
+import time
+import zlib
+import pstats
+import cProfile
+import threading
+import contextvars
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
 
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
@@ -12,21 +26,181 @@ TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 COHERE_API_KEY = os.getenv("COHERE_API_KEY")
 
-from langchain_groq import ChatGroq
-from langchain_openai import ChatOpenAI
-from langchain_tavily import TavilySearch
-from langchain_cohere import CohereEmbeddings, CohereRerank
-from langchain_community.vectorstores import FAISS
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+# Provider SDKs (langchain_groq, langchain_openai, langchain_tavily, langchain_cohere,
+# FAISS, cohere) are imported on first use to keep cold starts fast
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
 from langchain_core.documents import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.embeddings import Embeddings
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
 from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages
 from typing_extensions import Annotated, TypedDict
-import cohere
-
-# Initialize Cohere client
-cohere_client = cohere.Client(COHERE_API_KEY) if COHERE_API_KEY else None
+import numpy as np
+
+# Cohere client, created on first use by get_cohere_client()
+cohere_client = None
+
+# Text splitting parameters shared by ingestion and context packing
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+# Embedding/rerank backend: "cohere", "local" (hashing, no extra dependencies)
+# or "sentence-transformers" (small local model, optionally on ONNX Runtime)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "cohere" if COHERE_API_KEY else "local")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# Worker processes extracting PDF text during bulk uploads (started on first bulk upload)
+BULK_EXTRACT_WORKERS = int(os.getenv("BULK_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+extract_pool = None
+LOCAL_EMBEDDING_DIM = int(os.getenv("LOCAL_EMBEDDING_DIM", "1024"))
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+LOCAL_EMBEDDING_RUNTIME = os.getenv("LOCAL_EMBEDDING_RUNTIME", "torch")  # "torch" or "onnx"
+
+
+def backend_cutoffs(name: str, defaults: Dict[str, float]) -> Dict[str, float]:
+    """Per-embedding-backend score cutoffs: <NAME> sets all backends, <BACKEND>_<NAME> one of them"""
+    shared = os.getenv(name)
+    return {
+        backend: float(os.getenv(f"{backend.upper().replace('-', '_')}_{name}", shared or default))
+        for backend, default in defaults.items()
+    }
+
+
+# RAG similarity threshold used when a request doesn't set one. Local rerank scores are raw
+# cosine similarities, far below Cohere's relevance scores for an equally good match.
+SIMILARITY_THRESHOLDS = backend_cutoffs(
+    "SIMILARITY_THRESHOLD", {"cohere": 0.5, "local": 0.08, "sentence-transformers": 0.3}
+)
+
+# Common English words ignored by the hashing embeddings
+HASHING_STOPWORDS = frozenset(
+    "a an and are as at be but by do does for from has have how i in is it its of on or "
+    "that the this to was were what when where which who why will with you your".split()
+)
+
+# Source-filtered searches gather the selected vectors directly when they are at most
+# this fraction of the store, otherwise FAISS scans the store with an ID selector
+SUBSET_SCAN_FRACTION = 0.3
+
+# Two-stage retrieval: with at least this many documents, queries are first matched
+# against per-document centroids and chunk search only runs inside the best documents
+HIERARCHICAL_MIN_DOCUMENTS = int(os.getenv("HIERARCHICAL_MIN_DOCUMENTS", "8"))
+HIERARCHICAL_TOP_DOCUMENTS = int(os.getenv("HIERARCHICAL_TOP_DOCUMENTS", "3"))
+# Queries whose best document centroid is less similar than this skip RAG entirely. Hashing
+# centroids score on- and off-topic queries alike, so there they only pick candidate documents.
+DOCUMENT_ROUTING_MIN_SIMILARITIES = backend_cutoffs(
+    "DOCUMENT_ROUTING_MIN_SIMILARITY", {"cohere": 0.1, "local": 0.0, "sentence-transformers": 0.1}
+)
+QUERY_VECTOR_CACHE_SIZE = 256
+# Ranked retrieval results kept per (user, normalized query, k, sources, index version)
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "1024"))
+
+# Users with at most this many chunks share one pooled FAISS index; larger ones get their own.
+# Off (0) by default: it saves little memory and adds filtering work to every pooled search.
+POOLED_TENANT_MAX_CHUNKS = int(os.getenv("POOLED_TENANT_MAX_CHUNKS", "0"))
+# Rebuild the pool once promoted users' leftover vectors outnumber live ones (and at least this many)
+POOL_COMPACT_MIN_DEAD = 1000
+
+# Conversation memory: the last few messages plus the most relevant older turns
+MEMORY_RECENT_MESSAGES = int(os.getenv("MEMORY_RECENT_MESSAGES", "6"))
+MEMORY_RELEVANT_TURNS = int(os.getenv("MEMORY_RELEVANT_TURNS", "3"))
+# Older turns less similar than this to the query are not recalled (hashing scores run lower)
+MEMORY_MIN_SIMILARITIES = backend_cutoffs(
+    "MEMORY_MIN_SIMILARITY", {"cohere": 0.3, "local": 0.1, "sentence-transformers": 0.3}
+)
+MEMORY_TURN_MAX_CHARS = 2000  # text embedded per turn
+
+# Context window sizes (in tokens) of the supported models
+MODEL_CONTEXT_WINDOWS = {
+    "llama3-70b-8192": 8192,
+    "llama-3.3-70b-versatile": 128000,
+    "gpt-4o-mini": 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Upper bound on tokens spent on retrieved document context per RAG turn
+RAG_CONTEXT_MAX_TOKENS = int(os.getenv("RAG_CONTEXT_MAX_TOKENS", "3000"))
+# Tokens kept free in the context window for the model's answer
+RESPONSE_TOKEN_RESERVE = 1024
+# Rough characters-per-token ratio used for budgeting
+CHARS_PER_TOKEN = 4
+
+# Provider of each supported model, used to pick failover and hedge targets
+MODEL_PROVIDERS = {
+    "llama3-70b-8192": "Groq",
+    "llama-3.3-70b-versatile": "Groq",
+    "gpt-4o-mini": "OpenAI",
+}
+PROVIDER_API_KEYS = {
+    "Groq": GROQ_API_KEY,
+    "OpenAI": OPENAI_API_KEY,
+}
+
+# Hedging and circuit breaker settings for LLM calls
+LLM_HEDGING_ENABLED = os.getenv("LLM_HEDGING_ENABLED", "true").lower() == "true"
+LLM_HEDGE_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_DELAY_SECONDS", "10"))  # used until p95 is known
+LLM_LATENCY_MIN_SAMPLES = 20
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+# Provider quotas in requests per minute, charged for every call made to the provider
+PROVIDER_RATE_LIMITS = {
+    "Groq": float(os.getenv("GROQ_RPM", "30")),
+    "OpenAI": float(os.getenv("OPENAI_RPM", "500")),
+    "Cohere": float(os.getenv("COHERE_RPM", "100")),
+}
+
+# Provider prices used for cost estimates (USD); update when provider pricing changes
+LLM_PRICES_PER_1M_TOKENS = {  # model -> (prompt, completion)
+    "llama3-70b-8192": (0.59, 0.79),
+    "llama-3.3-70b-versatile": (0.59, 0.79),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+COHERE_EMBED_PRICE_PER_1M_TOKENS = 0.10
+COHERE_RERANK_PRICE_PER_SEARCH = 0.002
+TAVILY_PRICE_PER_SEARCH = 0.008
+# Optional spending cap per user in USD (0 = unlimited)
+USER_COST_BUDGET_USD = float(os.getenv("USER_COST_BUDGET_USD", "0"))
+
+# Per-request profiling: sampling interval and number of stored reports
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_STORE_SIZE = int(os.getenv("PROFILE_STORE_SIZE", "100"))
+# cProfile covers every thread from one profiler on 3.12+ (sys.monitoring); before that it is per thread
+CPROFILE_PER_THREAD = sys.version_info < (3, 12)
+
+# Run retrieval and web search concurrently by default (can also be enabled per request)
+SPECULATIVE_ROUTING = os.getenv("SPECULATIVE_ROUTING", "false").lower() == "true"
+speculative_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("SPECULATIVE_WORKERS", "8")),
+    thread_name_prefix="speculative"
+)
+
+# Web search results are kept per session so follow-ups can answer without searching again
+SESSION_SEARCH_TTL_SECONDS = float(os.getenv("SESSION_SEARCH_TTL_SECONDS", "900"))
+SESSION_SEARCH_MAX_CHUNKS = int(os.getenv("SESSION_SEARCH_MAX_CHUNKS", "200"))
+# Minimum follow-up similarity to reuse a result; hashing cosine scores run far lower than Cohere's
+SESSION_SEARCH_THRESHOLDS = backend_cutoffs(
+    "SESSION_SEARCH_THRESHOLD", {"cohere": 0.5, "local": 0.12, "sentence-transformers": 0.4}
+)
+SESSION_SEARCH_TOP_K = 4
+session_search_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="session-search")
+
+# Deadline propagation: stages degrade instead of running past the request deadline
+LLM_RESERVE_SECONDS = float(os.getenv("LLM_RESERVE_SECONDS", "5"))  # kept free for the final answer
+RERANK_MIN_REMAINING_SECONDS = float(os.getenv("RERANK_MIN_REMAINING_SECONDS", "8"))
+SEARCH_MIN_REMAINING_SECONDS = float(os.getenv("SEARCH_MIN_REMAINING_SECONDS", "15"))
+deadline_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("DEADLINE_WORKERS", "16")),
+    thread_name_prefix="deadline"
+)
+
+# Tool loop on the search path: model steps allowed to request tools, and tool call concurrency
+AGENT_MAX_STEPS = int(os.getenv("AGENT_MAX_STEPS", "4"))
+TOOL_CALL_TIMEOUT_SECONDS = float(os.getenv("TOOL_CALL_TIMEOUT_SECONDS", "20"))
+tool_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("TOOL_WORKERS", "8")),
+    thread_name_prefix="tools"
+)
 
 
 class AgentState(TypedDict):
@@ -34,8 +208,100 @@ class AgentState(TypedDict):
     user_id: str
     session_id: str
     use_rag: bool
-    similarity_threshold: float
+    similarity_threshold: Optional[float]
     retrieved_docs: List[Document]
+    llm_id: str
+    search_results: str
+    sources: Optional[List[str]]
+    deadline: Any  # Deadline of the request, or None
+
+
+class Deadline:
+    """Time by which a request must finish, plus the degradations made to meet it"""
+
+    def __init__(self, seconds: Optional[float] = None):
+        self.seconds = seconds
+        self.start = time.monotonic()
+        self.expires_at = self.start + seconds if seconds else None
+        self.degradations = []
+        self.agent_steps = []  # timing of each tool loop step
+
+    def remaining(self) -> float:
+        if self.expires_at is None:
+            return float("inf")
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def allows(self, seconds: float) -> bool:
+        """Whether at least this many seconds are left"""
+        return self.remaining() >= seconds
+
+    def degrade(self, action: str):
+        if action not in self.degradations:
+            self.degradations.append(action)
+            if self.expires_at is None:
+                print(f"Degraded: {action}")
+            else:
+                print(f"Deadline: {action} ({self.remaining():.1f}s left)")
+
+    def call(self, fn, *args, reserve: float = 0.0):
+        """Run fn(*args), raising TimeoutError if it would eat into the reserved time"""
+        if self.expires_at is None:
+            return fn(*args)
+        timeout = self.remaining() - reserve
+        if timeout <= 0:
+            raise TimeoutError("No time left for this stage")
+        try:
+            # The call keeps running in the pool after a timeout; its result is discarded
+            return submit_with_context(deadline_executor, fn, *args).result(timeout=timeout)
+        except FuturesTimeoutError:
+            raise TimeoutError(f"Stage exceeded its {timeout:.1f}s share of the deadline")
+
+    def metadata(self) -> Dict[str, Any]:
+        return {
+            "deadline_seconds": self.seconds,
+            "elapsed_seconds": round(time.monotonic() - self.start, 3),
+            "degradations": list(self.degradations),
+            "agent_steps": list(self.agent_steps),
+        }
+
+
+class ReadWriteLock:
+    """Any number of concurrent readers or a single writer; waiting writers hold off new readers"""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
 
 
 class MemoryManager:
@@ -43,187 +309,1768 @@ class MemoryManager:
 
     def __init__(self):
         self.sessions = {}
+        # session_id -> {"vectors": (n, d) float16 array, "spans": [(start, end)], "embedded_upto": int}
+        self.turn_indexes = {}
+        # Held only for in-memory list operations, never across I/O
+        self.lock = threading.Lock()
 
     def get_session_history(self, session_id: str) -> List[Dict]:
-        return self.sessions.get(session_id, [])
+        with self.lock:
+            return list(self.sessions.get(session_id, []))
+
+    def get_session_history_page(
+            self,
+            session_id: str,
+            cursor: Optional[int] = None,
+            since: Optional[str] = None,
+            limit: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Return the messages after a cursor (index) or timestamp, at most `limit` of them"""
+        history = self.get_session_history(session_id)
+        start = max(cursor or 0, 0)
+
+        if since:
+            # Timestamps are ISO formatted, so string comparison preserves order
+            while start < len(history) and history[start]["timestamp"] <= since:
+                start += 1
+
+        end = len(history) if limit is None else min(len(history), start + max(limit, 0))
+        return {
+            "history": history[start:end],
+            "next_cursor": end,
+            "total": len(history),
+            "has_more": end < len(history)
+        }
 
     def add_to_session(self, session_id: str, message: Dict):
-        if session_id not in self.sessions:
-            self.sessions[session_id] = []
-        self.sessions[session_id].append({
-            **message,
-            "timestamp": datetime.now().isoformat()
-        })
+        self.add_messages_to_session(session_id, [message])
+
+    def add_messages_to_session(self, session_id: str, messages: List[Dict]):
+        """Append messages atomically so concurrent turns in a session don't interleave"""
+        timestamp = datetime.now().isoformat()
+        with self.lock:
+            self.sessions.setdefault(session_id, []).extend(
+                {**message, "timestamp": timestamp} for message in messages
+            )
 
     def clear_session(self, session_id: str):
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        with self.lock:
+            self.sessions.pop(session_id, None)
+            self.turn_indexes.pop(session_id, None)
+
+    @staticmethod
+    def _turn_spans(history: List[Dict], start: int, end: int) -> List[Tuple[int, int]]:
+        """Split history[start:end] into turns: human message(s) followed by the AI reply"""
+        spans = []
+        turn_start = start
+        for i in range(start + 1, end):
+            if history[i]["type"] == "human" and history[i - 1]["type"] == "ai":
+                spans.append((turn_start, i))
+                turn_start = i
+        if turn_start < end:
+            spans.append((turn_start, end))
+        return spans
+
+    def _index_turns(self, session_id: str, history: List[Dict], cutoff: int):
+        """Embed the turns before cutoff that are not in the session's index yet"""
+        with self.lock:
+            index = self.turn_indexes.get(session_id)
+            embedded_upto = index["embedded_upto"] if index else 0
+        if cutoff <= embedded_upto:
+            return
+
+        spans = self._turn_spans(history, embedded_upto, cutoff)
+        texts = [
+            "\n".join(m["content"] for m in history[start:end])[:MEMORY_TURN_MAX_CHARS]
+            for start, end in spans
+        ]
+        vectors = np.array(rag_manager.embeddings.embed_documents(texts), dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        usage_tracker.record(f"{rag_manager.backend}-embed",
+                             embedding_tokens=sum(estimate_tokens(text) for text in texts))
+
+        with self.lock:
+            index = self.turn_indexes.get(session_id)
+            if session_id not in self.sessions or (index["embedded_upto"] if index else 0) != embedded_upto:
+                return  # another request indexed these turns first, or the session was cleared
+            if index is None:
+                index = {"vectors": np.empty((0, vectors.shape[1]), dtype=np.float16), "spans": []}
+            self.turn_indexes[session_id] = {
+                "vectors": np.vstack([index["vectors"], vectors.astype(np.float16)]),
+                "spans": index["spans"] + spans,
+                "embedded_upto": cutoff,
+            }
+
+    def get_context_messages(self, session_id: str, query: str,
+                             recent: int = MEMORY_RECENT_MESSAGES,
+                             k: int = MEMORY_RELEVANT_TURNS) -> List[Dict]:
+        """Recent messages preceded by the k older turns most relevant to the query"""
+        history = self.get_session_history(session_id)
+
+        # Start the recent window on a turn boundary
+        cutoff = max(len(history) - recent, 0)
+        while 0 < cutoff < len(history) and not (
+                history[cutoff]["type"] == "human" and history[cutoff - 1]["type"] == "ai"):
+            cutoff -= 1
+        recent_messages = history[cutoff:]
+        if cutoff == 0 or k <= 0 or not rag_manager.rag_available:
+            return recent_messages
+
+        try:
+            self._index_turns(session_id, history, cutoff)
+            with self.lock:
+                index = self.turn_indexes.get(session_id)
+            if index is None:
+                return recent_messages
+
+            query_vector = rag_manager.embed_query(query)[0]
+            query_vector = query_vector / max(float(np.linalg.norm(query_vector)), 1e-12)
+            # Only turns older than the recent window are candidates
+            candidates = [i for i, (_, end) in enumerate(index["spans"]) if end <= cutoff]
+            scores = index["vectors"][candidates].astype(np.float32) @ query_vector
+            min_similarity = rag_manager.backend_cutoff(MEMORY_MIN_SIMILARITIES)
+            best = [candidates[i] for i in np.argsort(-scores)[:k] if scores[i] >= min_similarity]
+
+            relevant = []
+            for i in sorted(best):
+                start, end = index["spans"][i]
+                relevant.extend(history[start:end])
+            return relevant + recent_messages
+        except Exception as e:
+            print(f"Error recalling conversation memory: {e}")
+            return recent_messages
+
+
+class HashingEmbeddings(Embeddings):
+    """Local CPU embeddings using the hashing trick over word unigrams and bigrams"""
+
+    def __init__(self, dimension: int = LOCAL_EMBEDDING_DIM, batch_size: int = EMBEDDING_BATCH_SIZE):
+        self.dimension = dimension
+        self.batch_size = batch_size
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = [t for t in re.findall(r"\w+", text.lower()) if t not in HASHING_STOPWORDS]
+            features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+            for feature in features:
+                # crc32 is stable across processes, unlike hash()
+                h = zlib.crc32(feature.encode("utf-8"))
+                vectors[row, (h & 0x7FFFFFFF) % self.dimension] += 1.0 if h & 0x80000000 else -1.0
+
+        # Sublinear term frequency, then L2 normalise so inner product == cosine
+        vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        embedded = []
+        for i in range(0, len(texts), self.batch_size):
+            embedded.extend(self._embed_batch(texts[i:i + self.batch_size]).tolist())
+        return embedded
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed_batch([text])[0].tolist()
+
+
+class SentenceTransformerEmbeddings(Embeddings):
+    """Local CPU embeddings from a small sentence-transformers model"""
+
+    def __init__(self, model_name: str = LOCAL_EMBEDDING_MODEL, runtime: str = LOCAL_EMBEDDING_RUNTIME,
+                 batch_size: int = EMBEDDING_BATCH_SIZE):
+        from sentence_transformers import SentenceTransformer
+
+        if runtime == "onnx":
+            self.model = SentenceTransformer(model_name, device="cpu", backend="onnx")
+        else:
+            self.model = SentenceTransformer(model_name, device="cpu")
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.model.encode(
+            texts, batch_size=self.batch_size, normalize_embeddings=True, show_progress_bar=False
+        ).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class EmbeddingReranker:
+    """Local reranker scoring documents by cosine similarity to the query"""
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+
+    def rerank(self, documents: List[str], query: str) -> List[Dict[str, Any]]:
+        """Same result shape as CohereRerank.rerank: index and relevance_score, best first"""
+        if not documents:
+            return []
+        doc_vectors = np.array(self.embeddings.embed_documents(documents), dtype=np.float32)
+        query_vector = np.array(self.embeddings.embed_query(query), dtype=np.float32)
+        scores = np.clip(doc_vectors @ query_vector, 0.0, 1.0)
+        return [
+            {"index": int(i), "relevance_score": float(scores[i])}
+            for i in np.argsort(-scores)
+        ]
+
+
+class QuotaEmbeddings(Embeddings):
+    """Embeddings that take one provider request per call from the provider's quota"""
+
+    def __init__(self, embeddings: Embeddings, provider: str):
+        self.embeddings = embeddings
+        self.provider = provider
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        provider_quotas.acquire(self.provider)
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        provider_quotas.acquire(self.provider)
+        return self.embeddings.embed_query(text)
+
+
+class QuotaReranker:
+    """Reranker that takes one provider request per call from the provider's quota"""
+
+    def __init__(self, reranker, provider: str):
+        self.reranker = reranker
+        self.provider = provider
+
+    def rerank(self, *args, **kwargs):
+        provider_quotas.acquire(self.provider)
+        return self.reranker.rerank(*args, **kwargs)
 
 
 class RAGManager:
     """Manages document storage and retrieval"""
 
-    def __init__(self):
+    def __init__(self, backend: str = EMBEDDING_BACKEND, pooled_max_chunks: int = POOLED_TENANT_MAX_CHUNKS):
+        # The embedding backend is loaded lazily by ensure_ready()
+        self.requested_backend = backend
+        self.backend = None
+        self._embeddings = None
+        self._reranker = None
+        self._cohere_available = False
+        self._text_splitter = None
+        self._init_lock = threading.Lock()
+
+        self.vector_stores = {}  # user_id -> dedicated FAISS store
+        self.source_positions = {}  # user_id -> {source: positions of its chunks in the user's store}
+        # Small users share one store and are found by their positions in it
+        self.pooled_max_chunks = pooled_max_chunks
+        self.pooled_store = None
+        self.pool_dead = 0  # vectors left behind in the pool by promoted users
+        self.pool_lock = ReadWriteLock()  # taken after the user lock, never before
+        self.compact_lock = threading.Lock()  # one pool rebuild at a time
+        self.document_index = {}  # user_id -> {"sources", "sums", "centroids"} per-document vectors
+        self.query_vectors = OrderedDict()  # recent query text -> embedding
+        self.query_vectors_lock = threading.Lock()
+        self.index_versions = {}  # user_id -> counter bumped whenever the user's chunks change
+        self.retrieval_cache = OrderedDict()  # key -> [(docstore id, score or None)]
+        self.retrieval_cache_lock = threading.Lock()
+        self.retrieval_cache_hits = 0
+        self.retrieval_cache_misses = 0
+        self.user_locks = {}  # user_id -> ReadWriteLock guarding that user's store
+        self.user_locks_guard = threading.Lock()
+
+    def user_lock(self, user_id: str) -> ReadWriteLock:
+        """Per-user reader/writer lock: searches share it, index updates take it exclusively"""
+        with self.user_locks_guard:
+            if user_id not in self.user_locks:
+                self.user_locks[user_id] = ReadWriteLock()
+            return self.user_locks[user_id]
+
+    def ensure_ready(self):
+        """Load the embedding/rerank backend on first use"""
+        if self.backend is None:
+            with self._init_lock:
+                if self.backend is None:
+                    self._load_backend(self.requested_backend)
+
+    def _load_backend(self, backend: str):
+        if backend == "cohere" and not COHERE_API_KEY:
+            print("Warning: COHERE_API_KEY not found. Using local embeddings for RAG.")
+            backend = "local"
+
         # Initialize embeddings with proper model parameter
-        if COHERE_API_KEY:
+        if backend == "cohere":
             try:
-                self.embeddings = CohereEmbeddings(
+                from langchain_cohere import CohereEmbeddings, CohereRerank
+
+                self._embeddings = QuotaEmbeddings(CohereEmbeddings(
                     cohere_api_key=COHERE_API_KEY,
                     model="embed-english-v3.0"  # Specify the model
-                )
-                self.reranker = CohereRerank(
+                ), "Cohere")
+                self._reranker = QuotaReranker(CohereRerank(
                     cohere_api_key=COHERE_API_KEY,
                     model="rerank-english-v3.0"  # Specify rerank model
-                )
-                self.cohere_available = True
+                ), "Cohere")
+                self._cohere_available = True
             except Exception as e:
                 print(f"Warning: Cohere initialization failed: {e}")
-                print("Falling back to basic similarity search without Cohere")
-                self.embeddings = None
-                self.reranker = None
-                self.cohere_available = False
-        else:
-            print("Warning: COHERE_API_KEY not found. RAG features will be limited.")
-            self.embeddings = None
-            self.reranker = None
-            self.cohere_available = False
-
-        self.vector_stores = {}  # user_id -> FAISS store
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len,
-        )
+                print("Falling back to local embeddings")
+                backend = "local"
+
+        if backend == "sentence-transformers":
+            try:
+                self._embeddings = SentenceTransformerEmbeddings()
+                self._reranker = EmbeddingReranker(self._embeddings)
+            except Exception as e:
+                print(f"Warning: sentence-transformers backend unavailable: {e}")
+                print("Falling back to hashing embeddings")
+                backend = "local"
+
+        if backend == "local":
+            self._embeddings = HashingEmbeddings()
+            self._reranker = EmbeddingReranker(self._embeddings)
+
+        if self._embeddings is None:
+            print(f"Warning: Unknown embedding backend '{backend}'. RAG features are disabled.")
+        self.backend = backend
+
+    @property
+    def embeddings(self):
+        self.ensure_ready()
+        return self._embeddings
+
+    @property
+    def reranker(self):
+        self.ensure_ready()
+        return self._reranker
+
+    @property
+    def cohere_available(self) -> bool:
+        self.ensure_ready()
+        return self._cohere_available
+
+    @property
+    def rag_available(self) -> bool:
+        self.ensure_ready()
+        return self._embeddings is not None
+
+    @property
+    def quota_provider(self) -> Optional[str]:
+        """Rate-limited provider behind the embeddings, if any (doesn't load the backend)"""
+        backend = self.backend or (self.requested_backend if COHERE_API_KEY else "local")
+        return "Cohere" if backend == "cohere" else None
+
+    def backend_cutoff(self, cutoffs: Dict[str, float]) -> float:
+        """Cutoff matching the score scale of the backend actually in use"""
+        self.ensure_ready()
+        return cutoffs.get(self.backend, cutoffs["cohere"])
+
+    @property
+    def default_similarity_threshold(self) -> float:
+        return self.backend_cutoff(SIMILARITY_THRESHOLDS)
+
+    @property
+    def text_splitter(self):
+        if self._text_splitter is None:
+            from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+            self._text_splitter = RecursiveCharacterTextSplitter(
+                chunk_size=CHUNK_SIZE,
+                chunk_overlap=CHUNK_OVERLAP,
+                length_function=len,
+            )
+        return self._text_splitter
 
     def process_pdf_content(self, user_id: str, pdf_content: str, filename: str):
         """Process PDF content and store in vector database"""
-        if not self.cohere_available:
-            print("Warning: Cohere not available. Cannot process PDF for RAG.")
+        if not self.rag_available:
+            print("Warning: No embedding backend available. Cannot process PDF for RAG.")
             return False
 
+        result = self.process_documents(user_id, [(filename, pdf_content)])[0]
+        if result["status"] != "indexed":
+            print(f"Error processing PDF content: {result.get('error')}")
+        return result["status"] == "indexed"
+
+    def process_documents(self, user_id: str, documents: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+        """Chunk, embed and index several documents in one pass; returns a status per document.
+
+        Chunks from all documents are packed into full EMBEDDING_BATCH_SIZE batches and
+        added to the user's store with a single index update.
+        """
+        results = [{"filename": filename, "status": "failed", "chunks": 0} for filename, _ in documents]
+        if not self.rag_available:
+            for result in results:
+                result["error"] = "No embedding backend available"
+            return results
+
+        # Split text into chunks
+        texts, metadatas, owners = [], [], []
+        for i, (filename, content) in enumerate(documents):
+            try:
+                chunks = self.text_splitter.split_text(content or "")
+            except Exception as e:
+                results[i]["error"] = str(e)
+                continue
+            if not chunks:
+                results[i]["error"] = "No text extracted"
+                continue
+
+            # Create metadata for each chunk
+            timestamp = datetime.now().isoformat()
+            texts.extend(chunks)
+            metadatas.extend(
+                {"source": filename, "user_id": user_id, "chunk_id": j, "timestamp": timestamp}
+                for j in range(len(chunks))
+            )
+            owners.extend([i] * len(chunks))
+            results[i]["chunks"] = len(chunks)
+
+        if not texts:
+            return results
+
         try:
-            # Split text into chunks
-            chunks = self.text_splitter.split_text(pdf_content)
-
-            # Create documents with metadata
-            documents = [
-                Document(
-                    page_content=chunk,
-                    metadata={
-                        "source": filename,
-                        "user_id": user_id,
-                        "chunk_id": i,
-                        "timestamp": datetime.now().isoformat()
-                    }
-                )
-                for i, chunk in enumerate(chunks)
-            ]
+            # Fail before embedding anything if the quota can't cover every batch
+            if self.quota_provider:
+                provider_quotas.check(self.quota_provider, math.ceil(len(texts) / EMBEDDING_BATCH_SIZE))
+
+            # Embed outside the lock so searches are only blocked for the index update
+            vectors = []
+            for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+                vectors.extend(self.embeddings.embed_documents(texts[start:start + EMBEDDING_BATCH_SIZE]))
+            usage_tracker.record(f"{self.backend}-embed", user_id=user_id,
+                                 embedding_tokens=sum(estimate_tokens(text) for text in texts))
+            text_embeddings = list(zip(texts, vectors))
+
+            # Consecutive runs of chunks per source, in index order
+            sources = []
+            for owner in owners:
+                if sources and sources[-1][0] == owner:
+                    sources[-1][1] += 1
+                else:
+                    sources.append([owner, 1])
+            sources = [(documents[owner][0], count) for owner, count in sources]
 
             # Create or update vector store for user
-            if user_id in self.vector_stores:
-                # Add to existing store
-                self.vector_stores[user_id].add_documents(documents)
-            else:
-                # Create new store
-                self.vector_stores[user_id] = FAISS.from_documents(
-                    documents, self.embeddings
-                )
-
-            return True
+            with self.user_lock(user_id).write():
+                if user_id in self.vector_stores:
+                    # Add to existing store
+                    start = self.vector_stores[user_id].index.ntotal
+                    self.vector_stores[user_id].add_embeddings(text_embeddings, metadatas=metadatas)
+                    self._add_positions(user_id, sources, start)
+                elif self.chunk_count(user_id) + len(texts) > self.pooled_max_chunks:
+                    # Past the pooling threshold: move to a dedicated store
+                    self._promote(user_id, text_embeddings, metadatas, sources)
+                else:
+                    with self.pool_lock.write():
+                        if self.pooled_store is None:
+                            start = 0
+                            self.pooled_store = load_faiss().from_embeddings(
+                                text_embeddings, self.embeddings, metadatas=metadatas
+                            )
+                        else:
+                            start = self.pooled_store.index.ntotal
+                            self.pooled_store.add_embeddings(text_embeddings, metadatas=metadatas)
+                        self._add_positions(user_id, sources, start)
+
+                self.index_versions[user_id] = self.index_versions.get(user_id, 0) + 1
+                all_vectors = np.asarray(vectors, dtype=np.float32)
+                owners = np.asarray(owners)
+                for i in np.unique(owners):
+                    self._update_document_index(user_id, documents[i][0], all_vectors[owners == i])
+        except ProviderQuotaExceeded:
+            raise
         except Exception as e:
-            print(f"Error processing PDF content: {e}")
-            return False
+            for result in results:
+                if result["chunks"]:
+                    result["error"] = str(e)
+            return results
 
-    def retrieve_relevant_docs(self, user_id: str, query: str, k: int = 3) -> List[Document]:
-        """Retrieve relevant documents for a query"""
-        if user_id not in self.vector_stores:
+        # Outside the user lock so the rebuild never blocks this or other users' searches
+        try:
+            self._compact_pool()
+        except Exception as e:
+            print(f"Warning: Pooled index compaction failed: {e}")
+
+        for result in results:
+            if result["chunks"]:
+                result["status"] = "indexed"
+        return results
+
+    def _add_positions(self, user_id: str, sources: List[Tuple[str, int]], start: int):
+        """Remember where each source's chunks live for filtered searches"""
+        positions = self.source_positions.setdefault(user_id, {})
+        for source, count in sources:
+            new_positions = np.arange(start, start + count, dtype=np.int64)
+            positions[source] = np.concatenate([positions.get(source, np.empty(0, dtype=np.int64)), new_positions])
+            start += count
+
+    def chunk_count(self, user_id: str) -> int:
+        return sum(len(positions) for positions in self.source_positions.get(user_id, {}).values())
+
+    def has_documents(self, user_id: str) -> bool:
+        return bool(self.source_positions.get(user_id))
+
+    def _promote(self, user_id: str, text_embeddings: List[Tuple[str, List[float]]],
+                 metadatas: List[Dict], sources: List[Tuple[str, int]]):
+        """Build a dedicated store from the user's pooled chunks plus new ones (caller holds the user lock)"""
+        if not self.source_positions.get(user_id):
+            # Nothing pooled to move (e.g. a new user with pooling off): build without blocking
+            # other users, then take the pool lock only to publish the store to compaction
+            store = load_faiss().from_embeddings(text_embeddings, self.embeddings, metadatas=metadatas)
+            with self.pool_lock.write():
+                self.vector_stores[user_id] = store
+                self._add_positions(user_id, sources, 0)
+            return
+
+        with self.pool_lock.write():
+            by_source = self.source_positions.get(user_id, {})
+            old_positions = np.sort(np.concatenate(list(by_source.values()))) if by_source \
+                else np.empty(0, dtype=np.int64)
+
+            texts, vectors, old_metadatas = [], [], []
+            if len(old_positions):
+                ids = [self.pooled_store.index_to_docstore_id[int(p)] for p in old_positions]
+                docs = [self.pooled_store.docstore.search(doc_id) for doc_id in ids]
+                texts = [doc.page_content for doc in docs]
+                vectors = list(self.pooled_store.index.reconstruct_batch(old_positions))
+                old_metadatas = [doc.metadata for doc in docs]
+                # The pooled vectors stay behind unreferenced until the pool is compacted
+                self.pooled_store.docstore.delete(ids)
+                self.pool_dead += len(old_positions)
+
+            self.vector_stores[user_id] = load_faiss().from_embeddings(
+                list(zip(texts + [text for text, _ in text_embeddings],
+                         vectors + [vector for _, vector in text_embeddings])),
+                self.embeddings,
+                metadatas=old_metadatas + metadatas
+            )
+            # Old chunks keep their order, so their new position is their rank
+            self.source_positions[user_id] = {
+                name: np.searchsorted(old_positions, positions) for name, positions in by_source.items()
+            }
+            self._add_positions(user_id, sources, len(old_positions))
+            if len(old_positions):
+                print(f"Promoted {user_id} to a dedicated index ({self.chunk_count(user_id)} chunks)")
+
+    def _pool_entries(self, positions: np.ndarray) -> Tuple[List[str], List, List[Dict]]:
+        """Texts, vectors and metadata stored at the given pool positions (caller holds a pool lock)"""
+        if len(positions) == 0:
+            return [], [], []
+        docs = [self.pooled_store.docstore.search(self.pooled_store.index_to_docstore_id[int(p)])
+                for p in positions]
+        return ([doc.page_content for doc in docs], list(self.pooled_store.index.reconstruct_batch(positions)),
+                [doc.metadata for doc in docs])
+
+    def _compact_pool(self):
+        """Rebuild the pool without promoted users' vectors once they outnumber live ones.
+
+        The new pool is built from a snapshot under the read lock; the write lock is only held
+        to append chunks added meanwhile and swap it in. A promotion during the build abandons it.
+        """
+        if not self.compact_lock.acquire(blocking=False):
+            return
+        try:
+            with self.pool_lock.read():
+                store, dead = self.pooled_store, self.pool_dead
+                if store is None or dead < POOL_COMPACT_MIN_DEAD or dead <= store.index.ntotal / 2:
+                    return
+                snapshot_total = store.index.ntotal
+                live = [p for u, by_source in self.source_positions.items() if u not in self.vector_stores
+                        for p in by_source.values()]
+                live = np.sort(np.concatenate(live)) if live else np.empty(0, dtype=np.int64)
+                texts, vectors, metadatas = self._pool_entries(live)
+
+            new_store = load_faiss().from_embeddings(
+                list(zip(texts, vectors)), self.embeddings, metadatas=metadatas
+            ) if texts else None
+
+            with self.pool_lock.write():
+                if self.pooled_store is not store or self.pool_dead != dead:
+                    return
+                # Chunks appended since the snapshot all belong to pooled users
+                tail = np.arange(snapshot_total, store.index.ntotal, dtype=np.int64)
+                if len(tail):
+                    texts, vectors, metadatas = self._pool_entries(tail)
+                    if new_store is None:
+                        new_store = load_faiss().from_embeddings(
+                            list(zip(texts, vectors)), self.embeddings, metadatas=metadatas
+                        )
+                    else:
+                        new_store.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas)
+                    live = np.concatenate([live, tail])
+
+                self.pooled_store = new_store
+                for user_id, by_source in self.source_positions.items():
+                    if user_id in self.vector_stores:
+                        continue
+                    self.source_positions[user_id] = {
+                        name: np.searchsorted(live, positions) for name, positions in by_source.items()
+                    }
+                    # Docstore ids changed, so cached retrievals no longer resolve
+                    self.index_versions[user_id] = self.index_versions.get(user_id, 0) + 1
+                self.pool_dead = 0
+            print(f"Compacted the pooled index: dropped {dead} vectors, kept {len(live)}")
+        finally:
+            self.compact_lock.release()
+
+    def _update_document_index(self, user_id: str, source: str, vectors: np.ndarray):
+        """Fold new chunk vectors into the source's centroid (caller holds the write lock)"""
+        index = self.document_index.setdefault(user_id, {"sources": [], "sums": None, "centroids": None})
+        chunk_sum = vectors.sum(axis=0, keepdims=True)
+
+        if source in index["sources"]:
+            index["sums"][index["sources"].index(source)] += chunk_sum[0]
+        else:
+            index["sources"].append(source)
+            index["sums"] = chunk_sum if index["sums"] is None else np.vstack([index["sums"], chunk_sum])
+
+        norms = np.linalg.norm(index["sums"], axis=1, keepdims=True)
+        index["centroids"] = index["sums"] / np.maximum(norms, 1e-12)
+
+    def embed_query(self, query: str) -> np.ndarray:
+        """Query embedding as a (1, dim) array, cached so one turn embeds each query once"""
+        with self.query_vectors_lock:
+            if query in self.query_vectors:
+                self.query_vectors.move_to_end(query)
+                return self.query_vectors[query]
+
+        vector = np.array([self.embeddings.embed_query(query)], dtype=np.float32)
+        usage_tracker.record(f"{self.backend}-embed", embedding_tokens=estimate_tokens(query))
+        with self.query_vectors_lock:
+            self.query_vectors[query] = vector
+            while len(self.query_vectors) > QUERY_VECTOR_CACHE_SIZE:
+                self.query_vectors.popitem(last=False)
+        return vector
+
+    def route_documents(self, user_id: str, query_vector: np.ndarray) -> Optional[Tuple[List[str], float]]:
+        """Best matching documents by centroid similarity, or None for small libraries"""
+        with self.user_lock(user_id).read():
+            index = self.document_index.get(user_id)
+            if not index or len(index["sources"]) < HIERARCHICAL_MIN_DOCUMENTS:
+                return None
+            sources, centroids = list(index["sources"]), index["centroids"]
+
+        query = query_vector[0] / max(float(np.linalg.norm(query_vector[0])), 1e-12)
+        similarities = centroids @ query
+        best = np.argsort(-similarities)[:HIERARCHICAL_TOP_DOCUMENTS]
+        return [sources[i] for i in best], float(similarities[best[0]])
+
+    def list_sources(self, user_id: str) -> List[str]:
+        """Names of the documents a user has uploaded"""
+        with self.user_lock(user_id).read(), self.pool_lock.read():
+            return list(self.source_positions.get(user_id, {}))
+
+    def _search_subset(self, store, query_vector: np.ndarray, positions: np.ndarray, k: int):
+        """Nearest neighbours among the given FAISS positions only"""
+        if len(positions) == 0:
             return []
+        k = min(k, len(positions))
+
+        if len(positions) <= store.index.ntotal * SUBSET_SCAN_FRACTION:
+            # Gather just the selected vectors so the cost scales with the selection
+            vectors = store.index.reconstruct_batch(positions)
+            distances = ((vectors - query_vector) ** 2).sum(axis=1)
+            best = np.argsort(distances)[:k]
+            return list(zip(positions[best], distances[best]))
+
+        import faiss
+        params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(positions))
+        distances, found = store.index.search(query_vector, k, params=params)
+        return list(zip(found[0], distances[0]))
+
+    def similarity_search_with_score(
+            self, user_id: str, query: str, k: int, sources: Optional[List[str]] = None
+    ) -> List[Tuple[Document, float]]:
+        """Closest chunks with their L2 distance, optionally only from the given sources"""
+        return [(doc, distance) for _, doc, distance in self._similarity_search_with_ids(user_id, query, k, sources)]
+
+    def _similarity_search_with_ids(
+            self, user_id: str, query: str, k: int, sources: Optional[List[str]] = None
+    ) -> List[Tuple[str, Document, float]]:
+        """Like similarity_search_with_score, with each chunk's docstore id first"""
+        query_vector = self.embed_query(query)
+
+        if not sources:
+            # Large libraries: only search inside the documents closest to the query
+            routed = self.route_documents(user_id, query_vector)
+            if routed:
+                sources = routed[0]
+
+        with self.user_lock(user_id).read():
+            if user_id in self.vector_stores:
+                return self._search_store(self.vector_stores[user_id], user_id, query_vector, k, sources)
+            # Pooled users only ever search their own positions
+            with self.pool_lock.read():
+                if self.pooled_store is None:
+                    return []
+                return self._search_store(self.pooled_store, user_id, query_vector, k,
+                                          sources or list(self.source_positions.get(user_id, {})))
+
+    def _search_store(self, store, user_id: str, query_vector: np.ndarray, k: int,
+                      sources: Optional[List[str]]) -> List[Tuple[str, Document, float]]:
+        """Search a store, restricted to the user's chunks from the given sources if any"""
+        if sources:
+            by_source = self.source_positions.get(user_id, {})
+            selected = [by_source[source] for source in sources if source in by_source]
+            positions = np.concatenate(selected) if selected else np.empty(0, dtype=np.int64)
+            hits = self._search_subset(store, query_vector, positions, k)
+        else:
+            distances, found = store.index.search(query_vector, min(k, store.index.ntotal))
+            hits = zip(found[0], distances[0])
+
+        return [
+            (doc_id, store.docstore.search(doc_id), float(distance))
+            for doc_id, distance in (
+                (store.index_to_docstore_id[int(position)], distance) for position, distance in hits if position != -1
+            )
+        ]
+
+    def retrieve_relevant_docs(self, user_id: str, query: str, k: int = 3,
+                               sources: Optional[List[str]] = None,
+                               deadline: Optional[Deadline] = None) -> List[Document]:
+        """Retrieve relevant documents for a query, optionally limited to some sources"""
+        if not self.has_documents(user_id):
+            return []
+
+        # Repeated questions against an unchanged index skip embedding, search and rerank
+        cache_key = (user_id, " ".join(query.lower().split()), k,
+                     tuple(sorted(sources)) if sources else None, self.index_versions.get(user_id, 0))
+        cached = self._cached_retrieval(user_id, cache_key)
+        if cached is not None:
+            return cached
 
+        deadline = deadline or Deadline()
         try:
-            # Retrieve similar documents
-            docs = self.vector_stores[user_id].similarity_search(query, k=k * 2)  # Get more for reranking
+            # Retrieve similar documents, getting more for reranking
+            hits = deadline.call(self._similarity_search_with_ids, user_id, query, k * 2, sources)
+            docs = [doc for _, doc, _ in hits]
 
             if not docs:
                 return []
 
-            # Rerank using Cohere if available
-            if self.cohere_available and self.reranker:
+            # Too little time left for a rerank round trip: keep the dense ranking
+            if self.reranker and not deadline.allows(RERANK_MIN_REMAINING_SECONDS):
+                deadline.degrade("dense_only_retrieval")
+                return docs[:k]
+
+            # Rerank using Cohere or the local reranker
+            if self.reranker:
                 try:
                     doc_texts = [doc.page_content for doc in docs]
-                    reranked = self.reranker.rerank(doc_texts, query)
+                    reranked = deadline.call(self.reranker.rerank, doc_texts, query, reserve=LLM_RESERVE_SECONDS)
+                    usage_tracker.record(f"{self.backend}-rerank", rerank_searches=1)
 
                     # Return top k reranked documents
                     reranked_docs = []
                     for result in reranked[:k]:
+                        # Copy so concurrent requests don't write into the stored document
                         original_doc = docs[result["index"]]
-                        original_doc.metadata["relevance_score"] = result["relevance_score"]
-                        reranked_docs.append(original_doc)
-
+                        reranked_docs.append(Document(
+                            page_content=original_doc.page_content,
+                            metadata={**original_doc.metadata, "relevance_score": result["relevance_score"]}
+                        ))
+
+                    self._cache_retrieval(cache_key, [
+                        (hits[result["index"]][0], result["relevance_score"]) for result in reranked[:k]
+                    ])
                     return reranked_docs
 
                 except Exception as e:
                     print(f"Reranking failed: {e}")
+                    if isinstance(e, TimeoutError):
+                        deadline.degrade("rerank_timed_out")
+                    elif isinstance(e, ProviderQuotaExceeded):
+                        deadline.degrade("rerank_rate_limited")
                     return docs[:k]
             else:
+                self._cache_retrieval(cache_key, [(doc_id, None) for doc_id, _, _ in hits[:k]])
                 return docs[:k]
         except Exception as e:
             print(f"Error retrieving documents: {e}")
+            if isinstance(e, TimeoutError):
+                deadline.degrade("retrieval_timed_out")
+            elif isinstance(e, ProviderQuotaExceeded):
+                deadline.degrade("retrieval_rate_limited")
             return []
 
-    def calculate_similarity_score(self, user_id: str, query: str) -> float:
+    def _cached_retrieval(self, user_id: str, cache_key: Tuple) -> Optional[List[Document]]:
+        """Resolve a cached ranking to documents, or None on a miss"""
+        with self.retrieval_cache_lock:
+            entry = self.retrieval_cache.get(cache_key)
+            if entry is None:
+                self.retrieval_cache_misses += 1
+                return None
+            self.retrieval_cache.move_to_end(cache_key)
+
+        with self.user_lock(user_id).read():
+            if user_id in self.vector_stores:
+                docs = [self.vector_stores[user_id].docstore.search(doc_id) for doc_id, _ in entry]
+            else:
+                with self.pool_lock.read():
+                    docs = [self.pooled_store.docstore.search(doc_id) for doc_id, _ in entry] \
+                        if self.pooled_store is not None else [None]
+
+        # The store changed since the ranking was cached (e.g. the pool was compacted)
+        if not all(isinstance(doc, Document) for doc in docs):
+            return None
+
+        with self.retrieval_cache_lock:
+            self.retrieval_cache_hits += 1
+        return [
+            doc if score is None else Document(page_content=doc.page_content,
+                                               metadata={**doc.metadata, "relevance_score": score})
+            for doc, (_, score) in zip(docs, entry)
+        ]
+
+    def _cache_retrieval(self, cache_key: Tuple, ranking: List[Tuple[str, Optional[float]]]):
+        """Store a full-quality ranking; degraded results are never cached"""
+        with self.retrieval_cache_lock:
+            self.retrieval_cache[cache_key] = ranking
+            self.retrieval_cache.move_to_end(cache_key)
+            while len(self.retrieval_cache) > RETRIEVAL_CACHE_SIZE:
+                self.retrieval_cache.popitem(last=False)
+
+    def calculate_similarity_score(self, user_id: str, query: str,
+                                   sources: Optional[List[str]] = None,
+                                   deadline: Optional[Deadline] = None) -> float:
         """Calculate similarity score to determine if RAG should be used"""
-        if user_id not in self.vector_stores:
+        if not self.has_documents(user_id):
             return 0.0
 
+        deadline = deadline or Deadline()
         try:
-            docs = self.retrieve_relevant_docs(user_id, query, k=1)
+            if not sources:
+                # Reject off-topic queries from the document-level index alone
+                query_vector = deadline.call(self.embed_query, query, reserve=LLM_RESERVE_SECONDS)
+                routed = self.route_documents(user_id, query_vector)
+                if routed and routed[1] < self.backend_cutoff(DOCUMENT_ROUTING_MIN_SIMILARITIES):
+                    print(f"Best document similarity {routed[1]:.3f} is below the routing minimum")
+                    return 0.0
+
+            docs = self.retrieve_relevant_docs(user_id, query, k=1, sources=sources, deadline=deadline)
             if docs and "relevance_score" in docs[0].metadata:
                 return docs[0].metadata.get('relevance_score', 0.0)
 
             # Fallback: use vector similarity
-            similar_docs = self.vector_stores[user_id].similarity_search_with_score(query, k=1)
+            similar_docs = deadline.call(self.similarity_search_with_score, user_id, query, 1, sources)
             if similar_docs:
                 return 1.0 - similar_docs[0][1]  # Convert distance to similarity
 
             return 0.0
         except Exception as e:
             print(f"Error calculating similarity: {e}")
+            if isinstance(e, TimeoutError):
+                deadline.degrade("retrieval_timed_out")
             return 0.0
 
 
+class SessionSearchIndex:
+    """Short-lived per-session vector index of web search results"""
+
+    def __init__(self, ttl_seconds: float = SESSION_SEARCH_TTL_SECONDS,
+                 max_chunks: int = SESSION_SEARCH_MAX_CHUNKS):
+        self.ttl_seconds = ttl_seconds
+        self.max_chunks = max_chunks
+        self.lock = threading.Lock()
+        # session_id -> {"vectors": (n, d) array, "chunks": [result dicts], "expires": (n,) array}
+        self.sessions = {}
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _prune(self, now: float):
+        """Drop expired chunks and empty sessions; caller holds the lock"""
+        for session_id in list(self.sessions):
+            entry = self.sessions[session_id]
+            keep = entry["expires"] > now
+            if keep.all():
+                continue
+            if not keep.any():
+                del self.sessions[session_id]
+                continue
+            entry["vectors"] = entry["vectors"][keep]
+            entry["expires"] = entry["expires"][keep]
+            entry["chunks"] = [chunk for chunk, kept in zip(entry["chunks"], keep) if kept]
+
+    def add_results(self, session_id: str, results: Any) -> int:
+        """Chunk, embed and store search results for a session; returns the number of new chunks"""
+        if not rag_manager.rag_available:
+            return 0
+
+        try:
+            with self.lock:
+                entry = self.sessions.get(session_id)
+                known = {(c["url"], c["content"]) for c in entry["chunks"]} if entry else set()
+
+            chunks = []
+            for result in parse_search_results(results):
+                for text in rag_manager.text_splitter.split_text(result.get("content") or ""):
+                    chunk = {"title": result.get("title", "Unknown"), "url": result.get("url", ""), "content": text}
+                    if (chunk["url"], text) not in known:
+                        known.add((chunk["url"], text))
+                        chunks.append(chunk)
+            if not chunks:
+                return 0
+
+            texts = [chunk["content"] for chunk in chunks]
+            vectors = self._normalize(np.array(rag_manager.embeddings.embed_documents(texts), dtype=np.float32))
+            usage_tracker.record(f"{rag_manager.backend}-embed",
+                                 embedding_tokens=sum(estimate_tokens(text) for text in texts))
+
+            now = time.monotonic()
+            expires = np.full(len(chunks), now + self.ttl_seconds)
+            with self.lock:
+                self._prune(now)
+                entry = self.sessions.get(session_id)
+                if entry is None:
+                    entry = {"vectors": vectors, "chunks": chunks, "expires": expires}
+                else:
+                    entry = {
+                        "vectors": np.vstack([entry["vectors"], vectors]),
+                        "chunks": entry["chunks"] + chunks,
+                        "expires": np.concatenate([entry["expires"], expires]),
+                    }
+                # Keep the newest chunks
+                entry = {key: value[-self.max_chunks:] for key, value in entry.items()}
+                self.sessions[session_id] = entry
+            return len(chunks)
+        except Exception as e:
+            print(f"Error indexing search results: {e}")
+            return 0
+
+    def search(self, session_id: str, query: str, k: int = SESSION_SEARCH_TOP_K) -> List[Tuple[Dict, float]]:
+        """Return the k most similar unexpired chunks as (result dict, cosine similarity)"""
+        with self.lock:
+            self._prune(time.monotonic())
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                return []
+            vectors, chunks = entry["vectors"], entry["chunks"]
+
+        try:
+            scores = vectors @ self._normalize(rag_manager.embed_query(query))[0]
+            top = np.argsort(-scores)[:k]
+            return [(chunks[i], float(scores[i])) for i in top]
+        except Exception as e:
+            print(f"Error searching session results: {e}")
+            return []
+
+    def clear_session(self, session_id: str):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+
+# Accepted X-Profile values; anything else leaves profiling off
+PROFILE_MODES = {"1": "sampling", "true": "sampling", "yes": "sampling", "sampling": "sampling",
+                 "deterministic": "deterministic"}
+
+
+def resolve_profile_mode(value: Optional[str]) -> Optional[str]:
+    """Map a client-supplied profile flag to a profiling mode, or None"""
+    if not value:
+        return None
+    return PROFILE_MODES.get(value.strip().lower())
+
+
+class RequestProfile:
+    """Profile of a single request: per-stage wall/CPU time plus sampled or deterministic call data"""
+
+    def __init__(self, request_id: str, mode: str = "sampling"):
+        self.request_id = request_id
+        if mode not in ("sampling", "deterministic"):
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.mode = mode
+        self.stages = []
+        self.lock = threading.Lock()
+        self.threads = {}  # thread id -> number of open stages
+        self.finished_profilers = []
+        self.stack_counts = {}  # collapsed stack -> samples (sampling mode)
+        self.stopped = threading.Event()
+        self.sampler = None
+        self.started_at = None
+        self.profiler = None  # request-wide cProfile (3.12+)
+        self.holds_profiler = False
+        self.fallback_reason = None
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        if self.mode == "deterministic" and not self._start_deterministic():
+            self.mode = "sampling"
+        if self.mode == "sampling":
+            self.sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+            self.sampler.start()
+
+    def _start_deterministic(self) -> bool:
+        """Claim cProfile for this request; False (sample instead) if something else is using it"""
+        if not deterministic_profile_lock.acquire(blocking=False):
+            self.fallback_reason = "another deterministic profile is running"
+            return False
+        self.holds_profiler = True
+        if CPROFILE_PER_THREAD:
+            # stage() starts one profiler per thread
+            return True
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            self.fallback_reason = str(e)
+            self.holds_profiler = False
+            deterministic_profile_lock.release()
+            return False
+        self.profiler = profiler
+        return True
+
+    def stop(self):
+        self.stopped.set()
+        if self.sampler:
+            self.sampler.join()
+        if self.profiler:
+            self.profiler.disable()
+            self.finished_profilers.append(self.profiler)
+        if self.holds_profiler:
+            self.holds_profiler = False
+            deterministic_profile_lock.release()
+
+    def _sample(self):
+        while not self.stopped.wait(PROFILE_SAMPLE_INTERVAL):
+            frames = sys._current_frames()
+            with self.lock:
+                thread_ids = list(self.threads)
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if stack:
+                    key = ";".join(reversed(stack))
+                    self.stack_counts[key] = self.stack_counts.get(key, 0) + 1
+
+    @contextmanager
+    def stage(self, name: str):
+        thread_id = threading.get_ident()
+        with self.lock:
+            outermost = thread_id not in self.threads
+            self.threads[thread_id] = self.threads.get(thread_id, 0) + 1
+
+        profiler = None
+        if outermost and self.mode == "deterministic" and CPROFILE_PER_THREAD:
+            # Before 3.12 cProfile only sees the thread that enabled it, so each thread gets its own
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiling tool owns this thread; time the stage without call data
+                profiler = None
+
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.thread_time() - cpu_start
+            if profiler:
+                profiler.disable()
+            with self.lock:
+                self.stages.append({
+                    "stage": name,
+                    "thread": threading.current_thread().name,
+                    "start_ms": round((wall_start - self.started_at) * 1000, 2),
+                    "wall_ms": round(wall * 1000, 2),
+                    "cpu_ms": round(cpu * 1000, 2)
+                })
+                if profiler:
+                    self.finished_profilers.append(profiler)
+                self.threads[thread_id] -= 1
+                if not self.threads[thread_id]:
+                    del self.threads[thread_id]
+
+    def collapsed_stacks(self) -> str:
+        """Samples in collapsed-stack format (flamegraph.pl, speedscope)"""
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(self.stack_counts.items()))
+
+    def report(self) -> Dict[str, Any]:
+        report = {
+            "request_id": self.request_id,
+            "mode": self.mode,
+            "stages": sorted(self.stages, key=lambda s: s["start_ms"]),
+        }
+        if self.fallback_reason:
+            report["fallback_reason"] = f"sampled instead of deterministic: {self.fallback_reason}"
+        if self.mode == "sampling":
+            report["sample_interval_ms"] = PROFILE_SAMPLE_INTERVAL * 1000
+            report["samples"] = sum(self.stack_counts.values())
+            report["collapsed_stacks"] = self.collapsed_stacks()
+        elif self.finished_profilers:
+            output = io.StringIO()
+            stats = pstats.Stats(self.finished_profilers[0], stream=output)
+            for profiler in self.finished_profilers[1:]:
+                stats.add(profiler)
+            stats.sort_stats("cumulative").print_stats(40)
+            report["stats"] = output.getvalue()
+        return report
+
+
+# Only one request at a time may use cProfile; others fall back to sampling
+deterministic_profile_lock = threading.Lock()
+# Profile of the request being handled in the current context, if profiling was requested
+current_profile: contextvars.ContextVar = contextvars.ContextVar("current_profile", default=None)
+profile_store = OrderedDict()  # request_id -> report
+profile_store_lock = threading.Lock()
+
+
+@contextmanager
+def profile_stage(name: str):
+    """Time a pipeline stage when the current request is being profiled"""
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    with profile.stage(name):
+        yield
+
+
+@contextmanager
+def profile_request(request_id: str, mode: Optional[str] = None):
+    """Profile everything inside the block if a mode is given and store the report"""
+    mode = resolve_profile_mode(mode)
+    if not mode:
+        yield None
+        return
+
+    profile = RequestProfile(request_id, mode)
+    token = current_profile.set(profile)
+    profile.start()
+    try:
+        with profile.stage("request"):
+            yield profile
+    finally:
+        profile.stop()
+        current_profile.reset(token)
+        with profile_store_lock:
+            profile_store[request_id] = profile.report()
+            while len(profile_store) > PROFILE_STORE_SIZE:
+                profile_store.popitem(last=False)
+
+
+def get_profile(request_id: str) -> Optional[Dict[str, Any]]:
+    """Return a stored profile report"""
+    with profile_store_lock:
+        return profile_store.get(request_id)
+
+
+def profiled(name: str, node):
+    """Wrap a graph node so it shows up as a profiling stage"""
+    def wrapper(state):
+        with profile_stage(name):
+            return node(state)
+    return wrapper
+
+
+def submit_with_context(executor, fn, *args):
+    """Submit to an executor, carrying over context variables such as the active profile"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+class ProviderQuotaExceeded(Exception):
+    """Raised when a provider's request quota is used up; retry_after says when one is free"""
+
+    def __init__(self, provider: str, retry_after: float):
+        super().__init__(f"{provider} rate limit reached")
+        self.detail = str(self)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, tokens: float = 1.0) -> float:
+        """Seconds until `tokens` can be taken (a request larger than the bucket needs it full)"""
+        self._refill()
+        needed = min(tokens, self.capacity)
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """Take tokens if available; otherwise return the seconds until they will be"""
+        wait_seconds = self.wait_time(tokens)
+        if wait_seconds == 0.0:
+            # Oversized requests leave the bucket in debt
+            self.tokens -= tokens
+        return wait_seconds
+
+
+class ProviderQuotas:
+    """Per-provider request quotas shared by every thread making provider calls"""
+
+    def __init__(self, limits: Dict[str, float]):
+        self.lock = threading.Lock()
+        self.buckets = {
+            provider: TokenBucket(rate=rpm / 60.0, capacity=max(1.0, rpm))
+            for provider, rpm in limits.items()
+        }
+
+    def check(self, provider: str, requests: float = 1.0):
+        """Raise ProviderQuotaExceeded if the requests wouldn't fit now, without taking them"""
+        bucket = self.buckets.get(provider)
+        if bucket:
+            with self.lock:
+                wait_seconds = bucket.wait_time(requests)
+            if wait_seconds > 0:
+                raise ProviderQuotaExceeded(provider, wait_seconds)
+
+    def acquire(self, provider: str, requests: float = 1.0):
+        """Take requests from the provider's quota or raise ProviderQuotaExceeded"""
+        bucket = self.buckets.get(provider)
+        if bucket:
+            with self.lock:
+                wait_seconds = bucket.try_acquire(requests)
+            if wait_seconds > 0:
+                raise ProviderQuotaExceeded(provider, wait_seconds)
+
+
+class CircuitBreaker:
+    """Stops sending requests to a model after repeated failures, retrying after a cool-down"""
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_seconds: float = CIRCUIT_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        # Half-open: let a request through once the cool-down has passed
+        return time.monotonic() - self.opened_at >= self.reset_seconds
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class ProviderPool:
+    """Shared LLM clients with latency tracking, hedged requests and failover"""
+
+    def __init__(self, max_workers: int = int(os.getenv("LLM_POOL_WORKERS", "16"))):
+        self.clients = {}  # model -> chat model
+        self.search_tool = None
+        self.latencies = {}  # model -> recent successful call durations
+        self.breakers = {}  # model -> CircuitBreaker
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm")
+
+    def get_llm(self, provider: str, model: str):
+        """Return a cached chat model client for a provider/model pair"""
+        with self.lock:
+            if model not in self.clients:
+                if provider == "Groq":
+                    from langchain_groq import ChatGroq
+                    self.clients[model] = ChatGroq(model=model)
+                elif provider == "OpenAI":
+                    from langchain_openai import ChatOpenAI
+                    self.clients[model] = ChatOpenAI(model=model)
+                else:
+                    raise ValueError(f"Unsupported provider: {provider}")
+            return self.clients[model]
+
+    def get_search_tool(self):
+        """Return the shared Tavily search tool"""
+        with self.lock:
+            if self.search_tool is None:
+                from langchain_tavily import TavilySearch
+                self.search_tool = TavilySearch(max_results=2)
+            return self.search_tool
+
+    def _breaker(self, model: str) -> CircuitBreaker:
+        with self.lock:
+            return self.breakers.setdefault(model, CircuitBreaker())
+
+    def latency_percentile(self, model: str, percentile: float) -> Optional[float]:
+        with self.lock:
+            samples = sorted(self.latencies.get(model, []))
+        if len(samples) < LLM_LATENCY_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile))]
+
+    def hedge_delay(self, model: str) -> float:
+        """Wait this long for the primary before sending a hedged duplicate"""
+        p95 = self.latency_percentile(model, 0.95)
+        return p95 if p95 is not None else LLM_HEDGE_DELAY_SECONDS
+
+    def _timed_call(self, fn, provider: str, model: str):
+        # Every attempt, hedge and failover counts against its provider's quota
+        provider_quotas.acquire(provider)
+        start = time.monotonic()
+        # Usage is billed to the model we asked for, not the name the provider reports back
+        model_token = current_llm_model.set(model)
+        try:
+            with profile_stage(f"llm:{model}"):
+                result = fn(self.get_llm(provider, model))
+        except Exception:
+            with self.lock:
+                self.breakers.setdefault(model, CircuitBreaker()).record_failure()
+            raise
+        finally:
+            current_llm_model.reset(model_token)
+
+        with self.lock:
+            self.latencies.setdefault(model, deque(maxlen=200)).append(time.monotonic() - start)
+            self.breakers.setdefault(model, CircuitBreaker()).record_success()
+        return result
+
+    def invoke(self, fn, provider: str, model: str, fallback_models: Optional[List[str]] = None,
+               budget: Optional[float] = None):
+        """Run fn(llm) on the primary model, hedging and failing over to fallback models"""
+        candidates = [(provider, model)] + [
+            (MODEL_PROVIDERS[m], m) for m in (fallback_models or [])
+            if m != model and m in MODEL_PROVIDERS and PROVIDER_API_KEYS.get(MODEL_PROVIDERS[m])
+        ]
+        # Skip models whose circuit is open, but always keep at least the primary
+        queue = [c for c in candidates if self._breaker(c[1]).allow()] or candidates[:1]
+
+        start = time.monotonic()
+        deadline = start + budget if budget else None
+        hedge_at = start + self.hedge_delay(model) if LLM_HEDGING_ENABLED else None
+        pending = {}
+        last_error = None
+
+        while True:
+            if not pending:
+                if not queue:
+                    raise last_error or RuntimeError("No LLM provider available")
+                next_provider, next_model = queue.pop(0)
+                if next_model != model:
+                    print(f"Failing over to {next_model}")
+                pending[submit_with_context(self.executor, self._timed_call, fn, next_provider, next_model)] = next_model
+
+            now = time.monotonic()
+            timeouts = [t - now for t in (deadline, hedge_at) if t is not None]
+            done, _ = wait(list(pending), timeout=max(0.0, min(timeouts)) if timeouts else None,
+                           return_when=FIRST_COMPLETED)
+
+            for future in done:
+                finished_model = pending.pop(future)
+                try:
+                    return future.result()
+                except Exception as e:
+                    print(f"LLM call to {finished_model} failed: {e}")
+                    last_error = e
+
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                # Outstanding calls keep running in the pool; their results are discarded
+                raise TimeoutError(f"LLM request exceeded its {budget:.1f}s budget")
+
+            if hedge_at is not None and now >= hedge_at:
+                hedge_at = None
+                if pending and queue:
+                    hedge_provider, hedge_model = queue.pop(0)
+                    print(f"Hedging slow {model} request with {hedge_model}")
+                    pending[submit_with_context(self.executor, self._timed_call, fn, hedge_provider, hedge_model)] = hedge_model
+
+
+def load_faiss():
+    """Import the FAISS vector store class on first use"""
+    from langchain_community.vectorstores import FAISS
+    return FAISS
+
+
+def get_cohere_client():
+    """Return the shared Cohere client, creating it on first use"""
+    global cohere_client
+    if cohere_client is None and COHERE_API_KEY:
+        import cohere
+        cohere_client = cohere.Client(COHERE_API_KEY)
+    return cohere_client
+
+
+# (user_id, session_id, request totals) that provider usage in the current context is billed to
+current_usage_scope: contextvars.ContextVar = contextvars.ContextVar("current_usage_scope", default=(None, None, ()))
+# Model requested by the LLM call running in the current context
+current_llm_model: contextvars.ContextVar = contextvars.ContextVar("current_llm_model", default=None)
+# Callback handler added to every LangChain run in the current context
+usage_callback_var: contextvars.ContextVar = contextvars.ContextVar("usage_callback", default=None)
+register_configure_hook(usage_callback_var, True)
+
+
+class UsageTracker:
+    """Accumulates provider usage and estimated cost per user, session and resource"""
+
+    COUNTERS = ("llm_calls", "prompt_tokens", "completion_tokens", "embedding_tokens",
+                "rerank_searches", "search_calls", "cost_usd")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.unpriced_models = set()
+        self.by_user = {}
+        self.by_session = {}
+        self.by_resource = {}  # model or service name -> counters
+
+    def llm_prices(self, model: str) -> Tuple[float, float]:
+        """(prompt, completion) price per 1M tokens; dated names like gpt-4o-mini-2024-07-18 match by prefix"""
+        if model in LLM_PRICES_PER_1M_TOKENS:
+            return LLM_PRICES_PER_1M_TOKENS[model]
+        prefixes = [name for name in LLM_PRICES_PER_1M_TOKENS if model.startswith(name)]
+        if prefixes:
+            return LLM_PRICES_PER_1M_TOKENS[max(prefixes, key=len)]
+        if model not in self.unpriced_models:
+            self.unpriced_models.add(model)
+            print(f"Warning: no price entry for model '{model}'; its cost is not tracked")
+        return 0.0, 0.0
+
+    def estimate_cost(self, resource: str, counters: Dict[str, float]) -> float:
+        prompt_price = completion_price = 0.0
+        if counters.get("prompt_tokens") or counters.get("completion_tokens"):
+            prompt_price, completion_price = self.llm_prices(resource)
+        cost = (counters.get("prompt_tokens", 0) * prompt_price
+                + counters.get("completion_tokens", 0) * completion_price) / 1_000_000
+        if resource == "cohere-embed":
+            cost += counters.get("embedding_tokens", 0) * COHERE_EMBED_PRICE_PER_1M_TOKENS / 1_000_000
+        elif resource == "cohere-rerank":
+            cost += counters.get("rerank_searches", 0) * COHERE_RERANK_PRICE_PER_SEARCH
+        elif resource == "tavily":
+            cost += counters.get("search_calls", 0) * TAVILY_PRICE_PER_SEARCH
+        return cost
+
+    def record(self, resource: str, user_id: Optional[str] = None, session_id: Optional[str] = None,
+               **counters: float):
+        """Add usage for a resource, billed to the given or current user/session"""
+        scope_user, scope_session, scope_totals = current_usage_scope.get()
+        user_id = user_id or scope_user
+        session_id = session_id or scope_session
+        counters["cost_usd"] = self.estimate_cost(resource, counters)
+
+        with self.lock:
+            for table, key in ((self.by_user, user_id), (self.by_session, session_id),
+                               (self.by_resource, resource)):
+                if key is None:
+                    continue
+                totals = table.setdefault(key, dict.fromkeys(self.COUNTERS, 0))
+                for name, value in counters.items():
+                    totals[name] = totals.get(name, 0) + value
+            for totals in scope_totals:
+                for name, value in counters.items():
+                    totals[name] = totals.get(name, 0) + value
+
+    def get_usage(self, user_id: Optional[str] = None, session_id: Optional[str] = None) -> Dict[str, Any]:
+        with self.lock:
+            usage = {}
+            if user_id is not None:
+                usage["user"] = dict(self.by_user.get(user_id, dict.fromkeys(self.COUNTERS, 0)))
+            if session_id is not None:
+                usage["session"] = dict(self.by_session.get(session_id, dict.fromkeys(self.COUNTERS, 0)))
+            if user_id is None and session_id is None:
+                usage["resources"] = {name: dict(totals) for name, totals in self.by_resource.items()}
+            return usage
+
+    def over_budget(self, user_id: str) -> bool:
+        if USER_COST_BUDGET_USD <= 0:
+            return False
+        with self.lock:
+            return self.by_user.get(user_id, {}).get("cost_usd", 0) >= USER_COST_BUDGET_USD
+
+    def prometheus_metrics(self) -> str:
+        """Totals per resource in Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for counter in self.COUNTERS:
+                metric = f"ai_agent_{counter}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for resource, totals in sorted(self.by_resource.items()):
+                    lines.append(f'{metric}{{resource="{resource}"}} {totals.get(counter, 0)}')
+        return "\n".join(lines) + "\n"
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """Meters LLM tokens and web search calls made by LangChain runs"""
+
+    def on_llm_end(self, response, **kwargs):
+        model = current_llm_model.get() or (response.llm_output or {}).get("model_name")
+        prompt_tokens = completion_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None) or {}
+                prompt_tokens += usage.get("input_tokens", 0)
+                completion_tokens += usage.get("output_tokens", 0)
+                model = model or getattr(message, "response_metadata", {}).get("model_name")
+
+        if not prompt_tokens and not completion_tokens:
+            token_usage = (response.llm_output or {}).get("token_usage") or {}
+            prompt_tokens = token_usage.get("prompt_tokens", 0)
+            completion_tokens = token_usage.get("completion_tokens", 0)
+
+        usage_tracker.record(model or "unknown", llm_calls=1,
+                             prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        if "tavily" in ((serialized or {}).get("name") or ""):
+            usage_tracker.record("tavily", search_calls=1)
+
+
+@contextmanager
+def usage_scope(user_id: str, session_id: Optional[str] = None):
+    """Bill provider calls made inside the block to a user and session; yields the block's totals"""
+    totals = dict.fromkeys(UsageTracker.COUNTERS, 0)
+    _, _, outer_totals = current_usage_scope.get()
+    scope_token = current_usage_scope.set((user_id, session_id, outer_totals + (totals,)))
+    callback_token = usage_callback_var.set(usage_callback_var.get() or UsageCallbackHandler())
+    try:
+        yield totals
+    finally:
+        usage_callback_var.reset(callback_token)
+        current_usage_scope.reset(scope_token)
+
+
 # Global instances
 memory_manager = MemoryManager()
 rag_manager = RAGManager()
+provider_quotas = ProviderQuotas(PROVIDER_RATE_LIMITS)
+provider_pool = ProviderPool()
+session_search_index = SessionSearchIndex()
+usage_tracker = UsageTracker()
+
+# Readiness of lazily loaded components, filled in by warm_up()
+readiness = {"ready": False, "components": {}, "warm_up_seconds": None}
 
 
-def router_node(state: AgentState) -> AgentState:
+def router_node(state: AgentState, use_session_search: bool = False) -> AgentState:
     """Determines whether to use RAG, LLM, or Search based on query"""
     messages = state["messages"]
     user_query = messages[-1].content if messages else ""
     user_id = state.get("user_id", "default")
+    deadline = state.get("deadline") or Deadline()
+    has_documents = rag_manager.rag_available and rag_manager.has_documents(user_id)
 
-    # Only use RAG if Cohere is available and user has documents
-    if rag_manager.cohere_available and user_id in rag_manager.vector_stores:
+    # Leave whatever time is left to the answer itself
+    if has_documents and not deadline.allows(LLM_RESERVE_SECONDS):
+        deadline.degrade("retrieval_skipped")
+        has_documents = False
+
+    # Only use RAG if an embedding backend is available and user has documents
+    if has_documents:
         # Calculate similarity with stored documents
-        similarity_score = rag_manager.calculate_similarity_score(user_id, user_query)
-        threshold = state.get("similarity_threshold", 0.5)
+        with profile_stage("similarity"):
+            similarity_score = rag_manager.calculate_similarity_score(
+                user_id, user_query, state.get("sources"), deadline
+            )
+        threshold = state.get("similarity_threshold")
+        if threshold is None:
+            threshold = rag_manager.default_similarity_threshold
 
         print(f"Similarity score: {similarity_score}, Threshold: {threshold}")
 
         if similarity_score > threshold:
             # Use RAG
-            retrieved_docs = rag_manager.retrieve_relevant_docs(user_id, user_query)
+            with profile_stage("retrieval"):
+                retrieved_docs = rag_manager.retrieve_relevant_docs(
+                    user_id, user_query, sources=state.get("sources"), deadline=deadline
+                )
             state["retrieved_docs"] = retrieved_docs
             state["use_rag"] = True
             print("Router decision: Using RAG")
             return state
 
-    # Use regular LLM/Search
     state["use_rag"] = False
+
+    # Answer follow-ups from this session's earlier web search results
+    if use_session_search:
+        with profile_stage("session_search"):
+            hits = session_search_index.search(state.get("session_id", "default"), user_query)
+        threshold = rag_manager.backend_cutoff(SESSION_SEARCH_THRESHOLDS)
+        hits = [chunk for chunk, score in hits if score >= threshold]
+        if hits:
+            state["search_results"] = format_search_results(hits)
+            print(f"Router decision: Using {len(hits)} cached search results")
+            return state
+
+    # Use regular LLM/Search
     print("Router decision: Using LLM/Search")
     return state
 
 
+def parse_search_results(results: Any) -> List[Dict]:
+    """Normalize Tavily output (dict, list or JSON string) to a list of result dicts"""
+    if isinstance(results, str):
+        try:
+            results = json.loads(results)
+        except ValueError:
+            return []
+    if isinstance(results, dict):
+        results = results.get("results", [])
+    if not isinstance(results, list):
+        return []
+    return [r for r in results if isinstance(r, dict)]
+
+
+def format_search_results(results: Any) -> str:
+    """Render Tavily search output as plain-text prompt context"""
+    if isinstance(results, str) and not parse_search_results(results):
+        return results
+
+    return "\n\n".join([
+        f"Source: {r.get('title', 'Unknown')} ({r.get('url', '')})\n{r.get('content', '')}"
+        for r in parse_search_results(results)
+    ])
+
+
+def index_search_results(session_id: str, results: Any):
+    """Add search results to the session index in the background"""
+    submit_with_context(session_search_executor, session_search_index.add_results, session_id, results)
+
+
+def speculative_router_node(state: AgentState, search_tool) -> AgentState:
+    """Routes like router_node while a web search runs concurrently as a fallback"""
+    messages = state["messages"]
+    user_query = messages[-1].content if messages else ""
+    user_id = state.get("user_id", "default")
+
+    deadline = state.get("deadline") or Deadline()
+
+    # Without documents there is nothing to race against, so let the agent search normally
+    if not (rag_manager.rag_available and rag_manager.has_documents(user_id)):
+        return router_node(state, use_session_search=True)
+
+    if not deadline.allows(SEARCH_MIN_REMAINING_SECONDS):
+        deadline.degrade("web_search_skipped")
+        return router_node(state, use_session_search=True)
+
+    # A follow-up covered by earlier results needs no new search
+    hits = session_search_index.search(state.get("session_id", "default"), user_query, k=1)
+    if hits and hits[0][1] >= rag_manager.backend_cutoff(SESSION_SEARCH_THRESHOLDS):
+        return router_node(state, use_session_search=True)
+
+    def run_search():
+        with profile_stage("speculative_search"):
+            return search_tool.invoke({"query": user_query})
+
+    search_future = submit_with_context(speculative_executor, run_search)
+    state = router_node(state)
+
+    if state["use_rag"]:
+        # A search that has already started cannot be interrupted; its result is discarded
+        search_future.cancel()
+        print("Speculative search discarded: using RAG")
+        return state
+
+    try:
+        timeout = deadline.remaining() - LLM_RESERVE_SECONDS
+        results = search_future.result(timeout=max(0.0, timeout) if deadline.expires_at else None)
+        state["search_results"] = format_search_results(results)
+        index_search_results(state.get("session_id", "default"), results)
+        print("Speculative search used")
+    except FuturesTimeoutError:
+        deadline.degrade("web_search_timed_out")
+    except Exception as e:
+        print(f"Speculative search failed: {e}")
+    return state
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate used for context budgeting"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def get_context_token_budget(llm_id: str, messages: List) -> int:
+    """Tokens available for document context given the model and the rest of the prompt"""
+    window = MODEL_CONTEXT_WINDOWS.get(llm_id, DEFAULT_CONTEXT_WINDOW)
+    used = sum(estimate_tokens(str(m.content)) for m in messages)
+    return max(0, min(RAG_CONTEXT_MAX_TOKENS, window - used - RESPONSE_TOKEN_RESERVE))
+
+
+def _merge_overlapping_text(first: str, second: str, max_overlap: int = CHUNK_OVERLAP) -> str:
+    """Join two consecutive chunks, dropping the text the splitter repeated between them"""
+    limit = min(len(first), len(second), max_overlap)
+    for size in range(limit, 0, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return first + "\n" + second
+
+
+def _merge_source_chunks(docs: List[Document]) -> str:
+    """Merge the chunks of a single source into one passage, in document order"""
+    ordered = sorted(docs, key=lambda d: d.metadata.get("chunk_id", 0))
+    text = ordered[0].page_content
+    previous_id = ordered[0].metadata.get("chunk_id")
+    for doc in ordered[1:]:
+        chunk_id = doc.metadata.get("chunk_id")
+        if chunk_id == previous_id:
+            continue
+        if previous_id is not None and chunk_id == previous_id + 1:
+            text = _merge_overlapping_text(text, doc.page_content)
+        else:
+            text += "\n...\n" + doc.page_content
+        previous_id = chunk_id
+    return text
+
+
+def _render_context(docs: List[Document]) -> str:
+    """Group chunks by source and render them as prompt context"""
+    by_source = {}
+    for doc in docs:
+        by_source.setdefault(doc.metadata.get("source", "Unknown"), []).append(doc)
+
+    return "\n\n".join([
+        f"Document: {source}\n{_merge_source_chunks(source_docs)}"
+        for source, source_docs in by_source.items()
+    ])
+
+
+def pack_context(docs: List[Document], token_budget: int) -> str:
+    """Build RAG context from ranked chunks, merging overlaps and fitting the token budget"""
+    selected = []
+    seen = set()
+    context = ""
+
+    # Add chunks in relevance order until the budget is exhausted
+    for doc in docs:
+        key = (doc.metadata.get("source"), doc.metadata.get("chunk_id"), doc.page_content[:64])
+        if key in seen:
+            continue
+        seen.add(key)
+
+        candidate = _render_context(selected + [doc])
+        if estimate_tokens(candidate) <= token_budget:
+            selected.append(doc)
+            context = candidate
+            continue
+
+        # Fit as much of the chunk as the remaining budget allows
+        remaining_chars = (token_budget - estimate_tokens(context)) * CHARS_PER_TOKEN
+        overhead = len(candidate) - len(context) - len(doc.page_content)
+        keep_chars = remaining_chars - overhead
+        # The estimate assumes the cut chunk still merges with its neighbour; when it no
+        # longer overlaps, nothing is dropped, so shrink until the rendered context fits
+        while keep_chars > CHUNK_OVERLAP:
+            truncated = Document(page_content=doc.page_content[:keep_chars], metadata=doc.metadata)
+            candidate = _render_context(selected + [truncated])
+            excess = estimate_tokens(candidate) - token_budget
+            if excess <= 0:
+                context = candidate
+                break
+            keep_chars -= excess * CHARS_PER_TOKEN
+        break
+
+    return context
+
+
 def rag_node(state: AgentState) -> AgentState:
     """Handles RAG-based responses"""
     messages = state["messages"]
@@ -232,11 +2079,9 @@ def rag_node(state: AgentState) -> AgentState:
     if not retrieved_docs:
         return state
 
-    # Prepare context from retrieved documents
-    context = "\n\n".join([
-        f"Document: {doc.metadata.get('source', 'Unknown')}\n{doc.page_content}"
-        for doc in retrieved_docs
-    ])
+    # Prepare context from retrieved documents within the model's token budget
+    token_budget = get_context_token_budget(state.get("llm_id", ""), messages)
+    context = pack_context(retrieved_docs, token_budget)
 
     # Create enhanced prompt with context
     user_query = messages[-1].content
@@ -256,40 +2101,138 @@ Please provide a comprehensive answer based on the context provided."""
     return state
 
 
-def create_enhanced_agent(llm, tools=None, use_search=True):
+def _run_tool_call(tools_by_name: Dict[str, Any], tool_call: Dict) -> ToolMessage:
+    tool = tools_by_name.get(tool_call["name"])
+    if tool is None:
+        return ToolMessage(content=f"Error: unknown tool {tool_call['name']}",
+                           tool_call_id=tool_call["id"], name=tool_call["name"])
+    try:
+        result = tool.invoke(tool_call)
+        if isinstance(result, ToolMessage):
+            return result
+        return ToolMessage(content=str(result), tool_call_id=tool_call["id"], name=tool_call["name"])
+    except Exception as e:
+        return ToolMessage(content=f"Error: {e}", tool_call_id=tool_call["id"], name=tool_call["name"])
+
+
+def run_tool_loop(call_llm, tools: List, messages: List, deadline: Optional[Deadline] = None,
+                  max_steps: int = AGENT_MAX_STEPS) -> List:
+    """ReAct loop with a step cap: the tool calls of each step run concurrently.
+
+    Returns the new messages; the last one is the final answer.
+    """
+    deadline = deadline or Deadline()
+    tools_by_name = {tool.name: tool for tool in tools}
+    new_messages = []
+
+    for step in range(max_steps):
+        if not deadline.allows(SEARCH_MIN_REMAINING_SECONDS):
+            deadline.degrade("tool_loop_cut_short")
+            break
+
+        step_start = time.monotonic()
+        with profile_stage(f"agent_step:{step}"):
+            conversation = messages + new_messages
+            response = call_llm(lambda model: model.bind_tools(tools).invoke(conversation),
+                                reserve=LLM_RESERVE_SECONDS)
+        llm_seconds = time.monotonic() - step_start
+        new_messages.append(response)
+
+        tool_calls = getattr(response, "tool_calls", None) or []
+        timing = {"step": step, "llm_seconds": round(llm_seconds, 3), "tool_calls": len(tool_calls)}
+        if not tool_calls:
+            deadline.agent_steps.append(timing)
+            return new_messages
+
+        # Independent tool calls of one step run side by side
+        tools_start = time.monotonic()
+        with profile_stage(f"tools:{step}"):
+            futures = [submit_with_context(tool_executor, _run_tool_call, tools_by_name, tool_call)
+                       for tool_call in tool_calls]
+            step_deadline = tools_start + min(TOOL_CALL_TIMEOUT_SECONDS,
+                                              max(deadline.remaining() - LLM_RESERVE_SECONDS, 0.0))
+            for future, tool_call in zip(futures, tool_calls):
+                try:
+                    new_messages.append(future.result(timeout=max(step_deadline - time.monotonic(), 0.0)))
+                except FuturesTimeoutError:
+                    # The call keeps running in the pool; the model is told it timed out
+                    deadline.degrade("tool_call_timed_out")
+                    new_messages.append(ToolMessage(content="Error: tool call timed out",
+                                                    tool_call_id=tool_call["id"], name=tool_call["name"]))
+        timing["tool_seconds"] = round(time.monotonic() - tools_start, 3)
+        deadline.agent_steps.append(timing)
+    else:
+        deadline.degrade("tool_step_limit_reached")
+
+    # Out of steps or time: answer from what has been gathered, without further tool calls
+    conversation = messages + new_messages
+    new_messages.append(call_llm(lambda model: model.bind_tools(tools, tool_choice="none").invoke(conversation)))
+    return new_messages
+
+
+def create_enhanced_agent(llm, tools=None, use_search=True, speculative=False, call_llm=None):
     """Creates an enhanced agent with RAG, memory, and routing capabilities"""
 
+    if call_llm is None:
+        # Run LLM work directly against the given model
+        def call_llm(fn, reserve: float = 0.0):
+            return fn(llm)
+
     def agent_node(state: AgentState) -> AgentState:
         messages = state["messages"]
 
         if state.get("use_rag", False):
             # RAG response
-            response = llm.invoke(messages)
+            response = call_llm(lambda model: model.invoke(messages))
+            return {"messages": [response]}
+        elif state.get("search_results"):
+            # Answer from the speculatively fetched search results
+            search_prompt = f"""Use the following web search results to answer the user's question. Cite the sources you rely on.
+
+Search Results:
+{state["search_results"]}
+
+User Question: {messages[-1].content}"""
+            search_messages = messages[:-1] + [HumanMessage(content=search_prompt)]
+            response = call_llm(lambda model: model.invoke(search_messages))
             return {"messages": [response]}
         else:
-            # Regular LLM response with optional search
-            if use_search and tools:
+            # Regular LLM response with optional search, if the deadline leaves room for it
+            deadline = state.get("deadline") or Deadline()
+            search_allowed = use_search and tools and deadline.allows(SEARCH_MIN_REMAINING_SECONDS)
+            if use_search and tools and not search_allowed:
+                deadline.degrade("web_search_skipped")
+
+            if search_allowed:
                 try:
-                    from langgraph.prebuilt import create_react_agent
-                    react_agent = create_react_agent(llm, tools)
-                    result = react_agent.invoke({"messages": messages})
-                    return {"messages": result["messages"]}
+                    new_messages = run_tool_loop(call_llm, tools, messages, deadline)
+                    for message in new_messages:
+                        if isinstance(message, ToolMessage):
+                            index_search_results(state.get("session_id", "default"), message.content)
+                    return {"messages": new_messages}
                 except Exception as e:
                     print(f"Search agent failed: {e}")
+                    if isinstance(e, TimeoutError):
+                        deadline.degrade("web_search_timed_out")
                     # Fallback to regular LLM
-                    response = llm.invoke(messages)
+                    response = call_llm(lambda model: model.invoke(messages))
                     return {"messages": [response]}
             else:
-                response = llm.invoke(messages)
+                response = call_llm(lambda model: model.invoke(messages))
                 return {"messages": [response]}
 
     # Create the graph
     workflow = StateGraph(AgentState)
 
     # Add nodes
-    workflow.add_node("router", router_node)
-    workflow.add_node("rag", rag_node)
-    workflow.add_node("agent", agent_node)
+    if speculative and use_search and tools:
+        workflow.add_node("router", profiled("router", lambda state: speculative_router_node(state, tools[0])))
+    else:
+        workflow.add_node("router", profiled(
+            "router", lambda state: router_node(state, use_session_search=bool(use_search and tools))
+        ))
+    workflow.add_node("rag", profiled("rag", rag_node))
+    workflow.add_node("agent", profiled("agent", agent_node))
 
     # Add edges
     workflow.set_entry_point("router")
@@ -316,84 +2259,134 @@ def get_response_from_ai_agent(
         provider: str,
         user_id: str = "default",
         session_id: str = "default",
-        similarity_threshold: float = 0.5
+        similarity_threshold: Optional[float] = None,
+        speculative: Optional[bool] = None,
+        fallback_models: Optional[List[str]] = None,
+        llm_budget: Optional[float] = None,
+        sources: Optional[List[str]] = None,
+        deadline: Optional[Deadline] = None
 ):
     """Enhanced function with memory, RAG, and smart routing"""
+    deadline = deadline or Deadline()
 
     try:
-        # Initialize LLM
-        if provider == "Groq":
-            llm = ChatGroq(model=llm_id)
-        elif provider == "OpenAI":
-            llm = ChatOpenAI(model=llm_id)
-        else:
-            raise ValueError(f"Unsupported provider: {provider}")
-
-        # Initialize tools
-        tools = []
-        if allow_search:
-            try:
-                tools = [TavilySearch(max_results=2)]
-            except Exception as e:
-                print(f"Warning: Tavily search initialization failed: {e}")
-
-        # Get session history
-        session_history = memory_manager.get_session_history(session_id)
-
-        # Prepare messages with history
-        messages = [SystemMessage(content=system_prompt)]
-
-        # Add previous conversation history (last 10 messages)
-        for hist_msg in session_history[-10:]:
-            if hist_msg["type"] == "human":
-                messages.append(HumanMessage(content=hist_msg["content"]))
-            elif hist_msg["type"] == "ai":
-                messages.append(AIMessage(content=hist_msg["content"]))
-
-        # Add current query
-        messages.extend([HumanMessage(content=q) for q in query])
-
-        # Create enhanced agent
-        agent = create_enhanced_agent(llm, tools, allow_search)
-
-        # Prepare state
-        state = {
-            "messages": messages,
-            "user_id": user_id,
-            "session_id": session_id,
-            "use_rag": False,
-            "similarity_threshold": similarity_threshold,
-            "retrieved_docs": []
-        }
-
-        # Get response
-        response = agent.invoke(state)
-        final_messages = response.get("messages", [])
-
-        # Extract AI response
-        ai_messages = [m.content for m in final_messages if isinstance(m, AIMessage)]
-        final_response = ai_messages[-1] if ai_messages else "No response from agent."
-
-        # Save to memory
-        for q in query:
-            memory_manager.add_to_session(session_id, {
-                "type": "human",
-                "content": q
-            })
-
-        memory_manager.add_to_session(session_id, {
-            "type": "ai",
-            "content": final_response
-        })
-
-        return final_response
-
+        with usage_scope(user_id, session_id):
+            # Initialize LLM
+            llm = provider_pool.get_llm(provider, llm_id)
+
+            def call_llm(fn, reserve: float = 0.0):
+                # The LLM gets what is left of the request deadline (minus a reserve), up to its own budget
+                budget = llm_budget
+                if deadline.expires_at is not None:
+                    remaining = deadline.remaining() - reserve
+                    if remaining <= 0:
+                        raise TimeoutError("Request deadline exceeded before the LLM call")
+                    budget = min(budget, remaining) if budget else remaining
+                return provider_pool.invoke(fn, provider, llm_id, fallback_models, budget)
+
+            # Initialize tools
+            tools = []
+            if allow_search:
+                try:
+                    tools = [provider_pool.get_search_tool()]
+                except Exception as e:
+                    print(f"Warning: Tavily search initialization failed: {e}")
+
+            # Get the recent history plus relevant older turns
+            with profile_stage("memory"):
+                session_history = memory_manager.get_context_messages(session_id, "\n".join(query))
+
+            # Prepare messages with history
+            messages = [SystemMessage(content=system_prompt)]
+
+            # Add previous conversation history
+            for hist_msg in session_history:
+                if hist_msg["type"] == "human":
+                    messages.append(HumanMessage(content=hist_msg["content"]))
+                elif hist_msg["type"] == "ai":
+                    messages.append(AIMessage(content=hist_msg["content"]))
+
+            # Add current query
+            messages.extend([HumanMessage(content=q) for q in query])
+
+            # Create enhanced agent
+            if speculative is None:
+                speculative = SPECULATIVE_ROUTING
+            agent = create_enhanced_agent(llm, tools, allow_search, speculative, call_llm)
+
+            # Prepare state
+            state = {
+                "messages": messages,
+                "user_id": user_id,
+                "session_id": session_id,
+                "use_rag": False,
+                "similarity_threshold": similarity_threshold,
+                "retrieved_docs": [],
+                "llm_id": llm_id,
+                "search_results": "",
+                "sources": sources,
+                "deadline": deadline
+            }
+
+            # Get response
+            with profile_stage("graph"):
+                response = agent.invoke(state)
+            final_messages = response.get("messages", [])
+
+            # Extract AI response
+            ai_messages = [m.content for m in final_messages if isinstance(m, AIMessage)]
+            final_response = ai_messages[-1] if ai_messages else "No response from agent."
+
+            # Save to memory as one turn
+            memory_manager.add_messages_to_session(
+                session_id,
+                [{"type": "human", "content": q} for q in query] + [{"type": "ai", "content": final_response}]
+            )
+
+            return final_response
+
+    except ProviderQuotaExceeded:
+        raise
     except Exception as e:
         error_msg = f"Error in AI agent: {str(e)}"
         print(error_msg)
         return error_msg
 
 
+def _warm_embeddings():
+    # Local models load their weights on the first call; Cohere only needs its client
+    if rag_manager.rag_available and not rag_manager.cohere_available:
+        rag_manager.embeddings.embed_query("warm up")
+
+
+def warm_up():
+    """Load provider SDKs, clients and indices ahead of the first request"""
+    start = time.monotonic()
+    steps = {
+        "embeddings": _warm_embeddings,
+        "vector_store": load_faiss,
+        "text_splitter": lambda: rag_manager.text_splitter,
+        "cohere": get_cohere_client,
+    }
+    for model, provider in MODEL_PROVIDERS.items():
+        if PROVIDER_API_KEYS.get(provider):
+            steps[f"llm:{model}"] = lambda provider=provider, model=model: provider_pool.get_llm(provider, model)
+    if TAVILY_API_KEY:
+        steps["search"] = provider_pool.get_search_tool
+
+    for name, step in steps.items():
+        try:
+            step()
+            readiness["components"][name] = "ready"
+        except Exception as e:
+            print(f"Warning: warm-up of {name} failed: {e}")
+            readiness["components"][name] = f"failed: {e}"
+
+    readiness["warm_up_seconds"] = round(time.monotonic() - start, 3)
+    readiness["ready"] = True
+    print(f"Warm-up finished in {readiness['warm_up_seconds']}s")
+
+
 # Utility functions for PDF processing
 def extract_text_from_pdf(pdf_file) -> str:
     """Extract text from PDF file"""
@@ -435,36 +2428,134 @@ def process_uploaded_pdf(user_id: str, pdf_file, filename: str) -> bool:
         else:
             print("No text extracted from PDF")
             return False
+    except ProviderQuotaExceeded:
+        raise
     except Exception as e:
         print(f"Error processing PDF: {e}")
         return False
 
 
+def check_provider_quotas(llm_provider: Optional[str] = None, embeddings: bool = False):
+    """Raise ProviderQuotaExceeded up front if a provider the request needs has no quota left.
+
+    Nothing is taken here; each provider call takes its own request when it is made.
+    """
+    if llm_provider:
+        provider_quotas.check(llm_provider)
+    if embeddings and rag_manager.quota_provider:
+        provider_quotas.check(rag_manager.quota_provider)
+
+
+def _extract_text(pdf_file) -> str:
+    # Module-level so worker processes can resolve it by name
+    return extract_text_from_pdf(pdf_file)
+
+
+def get_extract_pool() -> ProcessPoolExecutor:
+    """Return the shared PDF extraction process pool, starting it on first use"""
+    global extract_pool
+    if extract_pool is None:
+        import multiprocessing
+        extract_pool = ProcessPoolExecutor(
+            max_workers=BULK_EXTRACT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return extract_pool
+
+
+def extract_texts(pdf_files: List[str]) -> List[Any]:
+    """Extract several PDFs in parallel processes; each entry is the text or the exception raised"""
+    if len(pdf_files) <= 1 or BULK_EXTRACT_WORKERS <= 1:
+        futures = None
+    else:
+        try:
+            futures = [get_extract_pool().submit(_extract_text, pdf_file) for pdf_file in pdf_files]
+        except Exception as e:
+            print(f"Warning: parallel PDF extraction unavailable: {e}")
+            futures = None
+
+    texts = []
+    for i, pdf_file in enumerate(pdf_files):
+        try:
+            texts.append(futures[i].result() if futures else _extract_text(pdf_file))
+        except Exception as e:
+            texts.append(e)
+    return texts
+
+
+def process_uploaded_pdfs(user_id: str, pdf_files: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+    """Extract (path, filename) PDFs in parallel and index them together; returns a status per file"""
+    texts = extract_texts([path for path, _ in pdf_files])
+    # Statuses are kept by position: several uploads may share a filename
+    results = [None] * len(pdf_files)
+    documents, positions = [], []
+    for i, ((_, filename), text) in enumerate(zip(pdf_files, texts)):
+        if isinstance(text, Exception):
+            results[i] = {"filename": filename, "status": "failed", "chunks": 0,
+                          "error": f"Text extraction failed: {text}"}
+        elif not text.strip():
+            results[i] = {"filename": filename, "status": "failed", "chunks": 0, "error": "No text extracted from PDF"}
+        else:
+            documents.append((filename, text))
+            positions.append(i)
+
+    for i, result in zip(positions, rag_manager.process_documents(user_id, documents)):
+        results[i] = result
+    return results
+
+
 def get_chat_history(session_id: str) -> List[Dict]:
     """Get chat history for a session"""
     return memory_manager.get_session_history(session_id)
 
 
+def get_chat_history_page(
+        session_id: str,
+        cursor: Optional[int] = None,
+        since: Optional[str] = None,
+        limit: Optional[int] = None
+) -> Dict[str, Any]:
+    """Get a page of chat history starting at a cursor or timestamp"""
+    return memory_manager.get_session_history_page(session_id, cursor, since, limit)
+
+
 def clear_chat_history(session_id: str):
     """Clear chat history for a session"""
     memory_manager.clear_session(session_id)
+    session_search_index.clear_session(session_id)
+
+
+def get_usage(user_id: Optional[str] = None, session_id: Optional[str] = None) -> Dict[str, Any]:
+    """Get token usage and estimated cost for a user and/or session (all resources if neither)"""
+    return usage_tracker.get_usage(user_id, session_id)
+
+
+def get_usage_metrics() -> str:
+    """Get usage totals in Prometheus text format"""
+    return usage_tracker.prometheus_metrics()
+
+
+def get_cache_metrics() -> str:
+    """Retrieval cache counters in Prometheus text format"""
+    return "\n".join([
+        "# TYPE ai_agent_retrieval_cache_hits_total counter",
+        f"ai_agent_retrieval_cache_hits_total {rag_manager.retrieval_cache_hits}",
+        "# TYPE ai_agent_retrieval_cache_misses_total counter",
+        f"ai_agent_retrieval_cache_misses_total {rag_manager.retrieval_cache_misses}",
+        "# TYPE ai_agent_retrieval_cache_entries gauge",
+        f"ai_agent_retrieval_cache_entries {len(rag_manager.retrieval_cache)}",
+    ]) + "\n"
+
+
+def is_over_budget(user_id: str) -> bool:
+    """Check whether a user has spent their USER_COST_BUDGET_USD"""
+    return usage_tracker.over_budget(user_id)
 
 
 def get_user_documents(user_id: str) -> List[str]:
     """Get list of documents uploaded by user"""
-    if not rag_manager.cohere_available or user_id not in rag_manager.vector_stores:
-        return []
-
     try:
-        # Extract unique document sources
-        docs = rag_manager.vector_stores[user_id].similarity_search("", k=1000)
-        sources = set()
-        for doc in docs:
-            source = doc.metadata.get('source', 'Unknown')
-            sources.add(source)
-
-        return list(sources)
+        return rag_manager.list_sources(user_id)
     except Exception as e:
         print(f"Error getting user documents: {e}")
         return []
-
@@ -3,17 +3,43 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
+import math
+import time
 import uuid
+import heapq
+import asyncio
+import itertools
+import zipfile
+import tempfile
+import threading
+from contextlib import asynccontextmanager
 from pydantic import BaseModel
 from typing import List, Optional
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from ai_agent_enhanced import (
     get_response_from_ai_agent,
+    Deadline,
     process_uploaded_pdf,
+    process_uploaded_pdfs,
+    check_provider_quotas,
+    ProviderQuotaExceeded,
     get_chat_history,
+    get_chat_history_page,
     clear_chat_history,
-    get_user_documents
+    get_user_documents,
+    get_usage,
+    get_usage_metrics,
+    get_cache_metrics,
+    is_over_budget,
+    usage_scope,
+    profile_request,
+    resolve_profile_mode,
+    get_profile,
+    readiness,
+    warm_up
 )
 
 
@@ -25,11 +51,17 @@ class RequestState(BaseModel):
     allow_search: bool
     user_id: Optional[str] = "default"
     session_id: Optional[str] = "default"
-    similarity_threshold: Optional[float] = 0.5
+    similarity_threshold: Optional[float] = None  # None: the embedding backend's default
+    speculative: Optional[bool] = None  # run retrieval and web search concurrently
+    profile: Optional[str] = None  # "sampling" or "deterministic" to profile this request
+    sources: Optional[List[str]] = None  # only retrieve from these uploaded documents
 
 
 class ChatHistoryRequest(BaseModel):
     session_id: str
+    cursor: Optional[int] = None  # index of the first message to return
+    since: Optional[str] = None  # only return messages after this ISO timestamp
+    limit: Optional[int] = None
 
 
 class ClearHistoryRequest(BaseModel):
@@ -40,13 +72,162 @@ class UserDocumentsRequest(BaseModel):
     user_id: str
 
 
+class UsageRequest(BaseModel):
+    user_id: Optional[str] = None
+    session_id: Optional[str] = None
+
+
 ALLOWED_MODEL_NAMES = [
     "llama3-70b-8192",
     "llama-3.3-70b-versatile",
     "gpt-4o-mini"
 ]
 
-app = FastAPI(title="Enhanced LangGraph AI Agent with RAG & Memory")
+# Wall-clock budget (seconds) for LLM calls, including hedged and failover attempts
+ENDPOINT_LLM_BUDGETS = {
+    "/chat": float(os.getenv("CHAT_LLM_BUDGET_SECONDS", "60")),
+}
+
+# End-to-end deadline (seconds) per endpoint, counted from arrival; stages degrade to meet it (0 = none)
+ENDPOINT_DEADLINES = {
+    "/chat": float(os.getenv("CHAT_DEADLINE_SECONDS", "60")),
+}
+
+# Bulk upload limits: PDFs per request (including those inside archives), bytes per PDF
+# and bytes written to disk per request (archives plus extracted PDFs)
+MAX_BULK_FILES = int(os.getenv("MAX_BULK_FILES", "500"))
+MAX_BULK_FILE_BYTES = int(os.getenv("MAX_BULK_FILE_BYTES", str(100 * 1024 * 1024)))
+MAX_BULK_UPLOAD_BYTES = int(os.getenv("MAX_BULK_UPLOAD_BYTES", str(1024 * 1024 * 1024)))
+UPLOAD_COPY_CHUNK_BYTES = 1024 * 1024
+
+# Largest page returned by a paginated /chat-history request
+MAX_HISTORY_PAGE_SIZE = 200
+
+# Admission control settings
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "16"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_PER_USER_LIMIT = int(os.getenv("ADMISSION_PER_USER_LIMIT", "4"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+
+# Lower value = served first when queued
+CHAT_PRIORITY = 0
+UPLOAD_PRIORITY = 1
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted; answered with a 429 and a retry hint"""
+
+    def __init__(self, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounded priority queue in front of the worker threadpool with per-user concurrency caps.
+
+    All methods run on the event loop thread, so no locking is needed.
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, per_user_limit: int, queue_timeout: float):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.per_user_limit = per_user_limit
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        self.waiters = []  # heap of (priority, sequence, future)
+        self.sequence = itertools.count()
+        self.user_in_flight = {}  # user_id -> active + queued requests
+        self.avg_service_seconds = 1.0
+
+    def retry_after_hint(self) -> float:
+        """Rough time until a queue slot frees up"""
+        return self.avg_service_seconds * (self.queued / max(self.max_concurrent, 1) + 1)
+
+    def _release_user(self, user_id: str):
+        remaining = self.user_in_flight.get(user_id, 1) - 1
+        if remaining > 0:
+            self.user_in_flight[user_id] = remaining
+        else:
+            self.user_in_flight.pop(user_id, None)
+
+    async def acquire(self, user_id: str, priority: int):
+        if self.user_in_flight.get(user_id, 0) >= self.per_user_limit:
+            raise AdmissionRejected("Too many concurrent requests for this user", retry_after=1)
+
+        if self.active < self.max_concurrent and not self.queued:
+            self.active += 1
+            self.user_in_flight[user_id] = self.user_in_flight.get(user_id, 0) + 1
+            return
+
+        if self.queued >= self.max_queue:
+            raise AdmissionRejected("Server is busy, please retry later", retry_after=self.retry_after_hint())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        self.queued += 1
+        self.user_in_flight[user_id] = self.user_in_flight.get(user_id, 0) + 1
+
+        try:
+            # release() hands its slot over by resolving the future
+            await asyncio.wait_for(future, self.queue_timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # The slot arrived just as we gave up, pass it on
+                self.release(user_id)
+            else:
+                future.cancel()
+                self.queued -= 1
+                self._release_user(user_id)
+            if isinstance(e, asyncio.TimeoutError):
+                raise AdmissionRejected("Timed out waiting for capacity", retry_after=self.retry_after_hint())
+            raise
+
+    def release(self, user_id: str):
+        self._release_user(user_id)
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                self.queued -= 1
+                future.set_result(True)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def admit(self, user_id: str, priority: int):
+        await self.acquire(user_id, priority)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.avg_service_seconds = 0.9 * self.avg_service_seconds + 0.1 * elapsed
+            self.release(user_id)
+
+
+admission_controller = AdmissionController(
+    ADMISSION_MAX_CONCURRENT, ADMISSION_MAX_QUEUE, ADMISSION_PER_USER_LIMIT, ADMISSION_QUEUE_TIMEOUT
+)
+
+# Allow clients to profile individual requests (X-Profile header or "profile" field).
+# Off by default: the API is public and profiles expose stacks and timings.
+ALLOW_REQUEST_PROFILING = os.getenv("ALLOW_REQUEST_PROFILING", "false").lower() == "true"
+
+WARM_UP_ON_STARTUP = os.getenv("WARM_UP_ON_STARTUP", "true").lower() == "true"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Serve /health immediately and warm providers in the background
+    if WARM_UP_ON_STARTUP:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    else:
+        readiness["ready"] = True
+    yield
+
+
+app = FastAPI(title="Enhanced LangGraph AI Agent with RAG & Memory", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -58,33 +239,76 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(AdmissionRejected)
+@app.exception_handler(ProviderQuotaExceeded)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    retry_after = max(1, math.ceil(exc.retry_after))
+    return JSONResponse(
+        status_code=429,
+        content={"error": exc.detail, "retry_after": retry_after},
+        headers={"Retry-After": str(retry_after)}
+    )
+
+
 @app.post("/chat")
-def chat_endpoint(request: RequestState):
+async def chat_endpoint(request: RequestState, x_profile: Optional[str] = Header(None)):
     """Enhanced chat endpoint with memory and RAG support"""
     if request.model_name not in ALLOWED_MODEL_NAMES:
         return {"error": "Invalid model name. Kindly select a valid AI model"}
 
+    deadline = Deadline(ENDPOINT_DEADLINES["/chat"])
+    user_id = request.user_id or "default"
+    if is_over_budget(user_id):
+        return {"error": "Usage budget exhausted for this user"}
+
+    profile_mode = resolve_profile_mode(request.profile or x_profile) if ALLOW_REQUEST_PROFILING else None
+
+    # Reject before queueing when a provider is out of quota; calls are charged as they are made
+    check_provider_quotas(request.model_provider, embeddings=True)
+    async with admission_controller.admit(user_id, CHAT_PRIORITY):
+        return await run_in_threadpool(process_chat_request, request, str(uuid.uuid4()), profile_mode, deadline)
+
+
+def process_chat_request(request: RequestState, request_id: str, profile_mode: Optional[str] = None,
+                         deadline: Optional[Deadline] = None):
+    """Run a chat request on a worker thread"""
     try:
         # Generate session ID if not provided
         session_id = request.session_id or str(uuid.uuid4())
         user_id = request.user_id or "default"
 
-        response = get_response_from_ai_agent(
-            llm_id=request.model_name,
-            query=request.messages,
-            allow_search=request.allow_search,
-            system_prompt=request.system_prompt,
-            provider=request.model_provider,
-            user_id=user_id,
-            session_id=session_id,
-            similarity_threshold=request.similarity_threshold
-        )
-
-        return {
+        with usage_scope(user_id, session_id) as request_usage, profile_request(request_id, profile_mode):
+            response = get_response_from_ai_agent(
+                llm_id=request.model_name,
+                query=request.messages,
+                allow_search=request.allow_search,
+                system_prompt=request.system_prompt,
+                provider=request.model_provider,
+                user_id=user_id,
+                session_id=session_id,
+                similarity_threshold=request.similarity_threshold,
+                speculative=request.speculative,
+                fallback_models=[m for m in ALLOWED_MODEL_NAMES if m != request.model_name],
+                llm_budget=ENDPOINT_LLM_BUDGETS["/chat"],
+                sources=request.sources,
+                deadline=deadline
+            )
+
+        result = {
             "response": response,
             "session_id": session_id,
-            "user_id": user_id
+            "user_id": user_id,
+            "request_id": request_id,
+            "history_cursor": len(get_chat_history(session_id)),
+            "usage": request_usage
         }
+        if deadline is not None:
+            result["metadata"] = deadline.metadata()
+        if profile_mode:
+            result["profile_url"] = f"/profiles/{request_id}"
+        return result
+    except ProviderQuotaExceeded:
+        raise
     except Exception as e:
         return {"error": f"Error processing request: {str(e)}"}
 
@@ -92,12 +316,19 @@ def chat_endpoint(request: RequestState):
 @app.post("/upload-pdf")
 async def upload_pdf(
         file: UploadFile = File(...),
-        user_id: str = "default"
+        user_id: str = Form("default")
 ):
     """Upload and process PDF for RAG"""
     if not file.filename.lower().endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
 
+    check_provider_quotas(embeddings=True)
+    async with admission_controller.admit(user_id, UPLOAD_PRIORITY):
+        return await process_pdf_upload(file, user_id)
+
+
+async def process_pdf_upload(file: UploadFile, user_id: str):
+    """Save the upload and index it on a worker thread"""
     try:
         # Save uploaded file temporarily
         temp_filename = f"temp_{uuid.uuid4()}_{file.filename}"
@@ -107,7 +338,7 @@ async def upload_pdf(
             temp_file.write(content)
 
         # Process PDF
-        success = process_uploaded_pdf(user_id, temp_filename, file.filename)
+        success = await run_in_threadpool(process_uploaded_pdf, user_id, temp_filename, file.filename)
 
         # Clean up temp file
         os.remove(temp_filename)
@@ -125,15 +356,122 @@ async def upload_pdf(
         # Clean up temp file if it exists
         if 'temp_filename' in locals() and os.path.exists(temp_filename):
             os.remove(temp_filename)
+        if isinstance(e, ProviderQuotaExceeded):
+            raise
         raise HTTPException(status_code=500, detail=f"Error processing PDF: {str(e)}")
 
 
+@app.post("/upload-pdfs")
+async def upload_pdfs(
+        files: List[UploadFile] = File(...),
+        user_id: str = Form("default")
+):
+    """Upload many PDFs and/or zip archives of PDFs and index them together"""
+    check_provider_quotas(embeddings=True)
+    async with admission_controller.admit(user_id, UPLOAD_PRIORITY):
+        uploads = [(upload.filename or "upload", upload.file) for upload in files]
+
+        with tempfile.TemporaryDirectory(prefix="bulk_upload_") as temp_dir:
+            pdf_files, skipped = await run_in_threadpool(save_bulk_upload, uploads, temp_dir)
+            try:
+                results = await run_in_threadpool(process_uploaded_pdfs, user_id, pdf_files)
+            except ProviderQuotaExceeded:
+                raise
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"Error processing PDFs: {str(e)}")
+
+    results += skipped
+    return {
+        "user_id": user_id,
+        "files": results,
+        "indexed": sum(1 for r in results if r["status"] == "indexed"),
+        "failed": sum(1 for r in results if r["status"] != "indexed"),
+        "chunks": sum(r["chunks"] for r in results)
+    }
+
+
+def save_bulk_upload(uploads: List[tuple], temp_dir: str):
+    """Copy (filename, file object) uploads, and the PDFs inside zip archives, to temp_dir.
+
+    Files are copied in chunks and the limits are enforced while copying, so no upload is
+    held in memory. Returns ([(path, filename)], [status of skipped entries]).
+    """
+    pdf_files, skipped = [], []
+    written = 0
+
+    def skip(filename: str, reason: str):
+        skipped.append({"filename": filename, "status": "skipped", "chunks": 0, "error": reason})
+
+    def copy(source, path: str, max_bytes: int) -> bool:
+        """Copy source to path; False (and nothing kept) if it is larger than max_bytes"""
+        nonlocal written
+        size = 0
+        with open(path, "wb") as target:
+            while True:
+                block = source.read(UPLOAD_COPY_CHUNK_BYTES)
+                if not block:
+                    return True
+                size += len(block)
+                written += len(block)
+                if written > MAX_BULK_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413,
+                                        detail=f"At most {MAX_BULK_UPLOAD_BYTES} bytes per bulk upload")
+                if size > max_bytes:
+                    written -= size
+                    break
+                target.write(block)
+        os.remove(path)
+        return False
+
+    def save(filename: str, source):
+        if len(pdf_files) >= MAX_BULK_FILES:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_FILES} PDFs per bulk upload")
+        path = os.path.join(temp_dir, f"{uuid.uuid4()}.pdf")
+        if copy(source, path, MAX_BULK_FILE_BYTES):
+            pdf_files.append((path, filename))
+        else:
+            skip(filename, "File too large")
+
+    for name, source in uploads:
+        if name.lower().endswith(".pdf"):
+            save(name, source)
+        elif name.lower().endswith(".zip"):
+            archive_path = os.path.join(temp_dir, f"{uuid.uuid4()}.zip")
+            copy(source, archive_path, MAX_BULK_UPLOAD_BYTES)
+            try:
+                with zipfile.ZipFile(archive_path) as archive:
+                    for member in archive.infolist():
+                        if member.is_dir():
+                            continue
+                        if not member.filename.lower().endswith(".pdf"):
+                            skip(member.filename, "Not a PDF")
+                        elif member.file_size > MAX_BULK_FILE_BYTES:
+                            skip(member.filename, "File too large")
+                        else:
+                            # file_size comes from the archive, so the copy enforces the limit too
+                            with archive.open(member) as member_source:
+                                save(member.filename, member_source)
+            except zipfile.BadZipFile:
+                skip(name, "Invalid zip archive")
+            finally:
+                os.remove(archive_path)
+        else:
+            skip(name, "Only PDF files and zip archives are allowed")
+
+    return pdf_files, skipped
+
+
 @app.post("/chat-history")
 def get_chat_history_endpoint(request: ChatHistoryRequest):
     """Get chat history for a session"""
     try:
-        history = get_chat_history(request.session_id)
-        return {"history": history, "session_id": request.session_id}
+        if request.cursor is None and request.since is None and request.limit is None:
+            history = get_chat_history(request.session_id)
+            return {"history": history, "session_id": request.session_id}
+
+        limit = min(request.limit or MAX_HISTORY_PAGE_SIZE, MAX_HISTORY_PAGE_SIZE)
+        page = get_chat_history_page(request.session_id, request.cursor, request.since, limit)
+        return {**page, "session_id": request.session_id}
     except Exception as e:
         return {"error": f"Error retrieving chat history: {str(e)}"}
 
@@ -158,12 +496,54 @@ def get_user_documents_endpoint(request: UserDocumentsRequest):
         return {"error": f"Error retrieving user documents: {str(e)}"}
 
 
+@app.get("/profiles/{request_id}")
+def get_profile_endpoint(request_id: str, format: str = "json"):
+    """Get the stored profile of a request; format=collapsed returns flamegraph input"""
+    report = get_profile(request_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail=f"No profile stored for request {request_id}")
+    if format == "collapsed":
+        return PlainTextResponse(report.get("collapsed_stacks", ""))
+    return report
+
+
+@app.post("/usage")
+def get_usage_endpoint(request: UsageRequest):
+    """Get token usage and estimated provider cost for a user and/or session"""
+    try:
+        return get_usage(request.user_id, request.session_id)
+    except Exception as e:
+        return {"error": f"Error retrieving usage: {str(e)}"}
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Usage counters, retrieval cache counters and admission gauges in Prometheus text format"""
+    gauges = [
+        "# TYPE ai_agent_admission_active gauge",
+        f"ai_agent_admission_active {admission_controller.active}",
+        "# TYPE ai_agent_admission_queued gauge",
+        f"ai_agent_admission_queued {admission_controller.queued}",
+    ]
+    return PlainTextResponse(get_usage_metrics() + get_cache_metrics() + "\n".join(gauges) + "\n")
+
+
 @app.get("/health")
 def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "message": "Enhanced AI Agent API is running"}
 
 
+@app.get("/ready")
+def readiness_check():
+    """Readiness endpoint: 503 until background warm-up has finished"""
+    status_code = 200 if readiness["ready"] else 503
+    return JSONResponse(
+        status_code=status_code,
+        content={"status": "ready" if readiness["ready"] else "warming_up", **readiness}
+    )
+
+
 @app.get("/")
 def root():
     """Root endpoint with API information"""
@@ -183,7 +563,9 @@ def root():
             "/chat-history": "Get chat history",
             "/clear-history": "Clear chat history",
             "/user-documents": "Get user documents",
-            "/health": "Health check"
+            "/profiles/{request_id}": "Get a stored request profile",
+            "/health": "Health check",
+            "/ready": "Readiness check (503 until warm-up completes)"
         }
     }
 
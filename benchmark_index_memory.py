@@ -0,0 +1,133 @@
+"""Memory benchmark for the per-user FAISS layouts.
+
+Indexes the same synthetic tenants twice, each in a fresh interpreter:
+  - dedicated: one FAISS store per user (POOLED_TENANT_MAX_CHUNKS=0)
+  - pooled:    small users share one store and are filtered by position
+               (POOLED_TENANT_MAX_CHUNKS=--pooled-max-chunks)
+and reports resident memory added by the indices, per-tenant overhead and search latency.
+
+Usage:
+    python benchmark_index_memory.py --tenants 100,1000,5000 --chunks-per-tenant 6 --pooled-max-chunks 500
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+WORDS = (
+    "revenue forecast contract policy clause warranty invoice schedule audit budget "
+    "quarter margin supplier delivery compliance liability renewal payment report summary "
+    "network latency cluster replica shard backup incident capacity deployment rollback"
+).split()
+
+
+def rss_bytes() -> int:
+    """Current resident set size of this process"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def synthetic_document(rng: random.Random, chunks: int, chunk_size: int) -> str:
+    words = []
+    while sum(len(w) + 1 for w in words) < chunks * chunk_size * 0.8:
+        words.append(rng.choice(WORDS))
+    return " ".join(words)
+
+
+def run_child(layout: str, tenants: int, chunks_per_tenant: int, queries: int, pooled_max_chunks: int):
+    """Build one layout and print its measurements as JSON"""
+    os.environ["EMBEDDING_BACKEND"] = "local"
+    import ai_agent_enhanced
+
+    if layout == "dedicated":
+        pooled_max_chunks = 0
+    rag_manager = ai_agent_enhanced.RAGManager("local", pooled_max_chunks=pooled_max_chunks)
+    rng = random.Random(42)
+    documents = [synthetic_document(rng, chunks_per_tenant, ai_agent_enhanced.CHUNK_SIZE) for _ in range(tenants)]
+    rag_manager.embeddings.embed_query("warm up")
+    rag_manager.text_splitter.split_text(documents[0])
+
+    gc.collect()
+    baseline = rss_bytes()
+    build_start = time.perf_counter()
+    for i, document in enumerate(documents):
+        rag_manager.process_pdf_content(f"tenant-{i}", document, f"doc-{i}.pdf")
+    build_seconds = time.perf_counter() - build_start
+    gc.collect()
+    index_bytes = rss_bytes() - baseline
+
+    query_texts = [" ".join(rng.sample(WORDS, 3)) for _ in range(20)]
+    for text in query_texts:
+        rag_manager.embed_query(text)
+    latencies = []
+    for _ in range(queries):
+        start = time.perf_counter()
+        rag_manager.similarity_search_with_score(f"tenant-{rng.randrange(tenants)}", rng.choice(query_texts), 6)
+        latencies.append(time.perf_counter() - start)
+
+    print(json.dumps({
+        "index_bytes": index_bytes,
+        "chunks": sum(rag_manager.chunk_count(f"tenant-{i}") for i in range(tenants)),
+        "stores": len(rag_manager.vector_stores) + (rag_manager.pooled_store is not None),
+        "build_seconds": build_seconds,
+        "search_p50_ms": statistics.median(latencies) * 1000,
+    }))
+
+
+def measure(layout: str, tenants: int, chunks_per_tenant: int, queries: int, pooled_max_chunks: int) -> dict:
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", layout,
+         "--tenants", str(tenants), "--chunks-per-tenant", str(chunks_per_tenant), "--queries", str(queries),
+         "--pooled-max-chunks", str(pooled_max_chunks)],
+        cwd=PROJECT_DIR, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{layout} run with {tenants} tenants failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tenants", default="100,1000,5000", help="comma-separated tenant counts")
+    parser.add_argument("--chunks-per-tenant", type=int, default=6, help="chunks per tenant (about a 3-page PDF)")
+    parser.add_argument("--queries", type=int, default=500, help="searches timed per run")
+    parser.add_argument("--pooled-max-chunks", type=int, default=500,
+                        help="pooling threshold for the pooled layout (pooling is off by default in the app)")
+    parser.add_argument("--child", choices=["dedicated", "pooled"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    tenant_counts = [int(n) for n in args.tenants.split(",")]
+    if args.child:
+        run_child(args.child, tenant_counts[0], args.chunks_per_tenant, args.queries, args.pooled_max_chunks)
+        return
+
+    print(f"Index memory benchmark ({args.chunks_per_tenant} chunks per tenant)\n")
+    print(f"{'tenants':>8} {'layout':<10} {'stores':>7} {'chunks':>8} {'index MB':>9} "
+          f"{'KB/tenant':>10} {'build s':>8} {'search p50 ms':>14}")
+    for tenants in tenant_counts:
+        results = {}
+        for layout in ("dedicated", "pooled"):
+            results[layout] = r = measure(layout, tenants, args.chunks_per_tenant, args.queries, args.pooled_max_chunks)
+            print(f"{tenants:>8} {layout:<10} {r['stores']:>7} {r['chunks']:>8} "
+                  f"{r['index_bytes'] / 2 ** 20:>9.1f} {r['index_bytes'] / tenants / 1024:>10.1f} "
+                  f"{r['build_seconds']:>8.1f} {r['search_p50_ms']:>14.3f}")
+        saved = results["dedicated"]["index_bytes"] - results["pooled"]["index_bytes"]
+        print(f"{'':>8} pooling saves {saved / 2 ** 20:.1f} MB "
+              f"({saved / max(results['dedicated']['index_bytes'], 1):.0%}, "
+              f"{saved / tenants / 1024:.1f} KB per tenant)\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Cold start benchmark for the FastAPI backend.
+
+Measures, in fresh interpreter processes:
+  - import time of backend_enhanced
+  - import time of each provider SDK that is now loaded on first use
+  - time until uvicorn answers /health and until /ready reports warm-up done
+
+Usage:
+    python benchmark_startup.py --runs 5
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules deferred from import time to first use
+DEFERRED_MODULES = [
+    "langchain_groq",
+    "langchain_openai",
+    "langchain_tavily",
+    "langchain_cohere",
+    "langchain_community.vectorstores",
+    "cohere",
+    "langchain.text_splitter",
+]
+
+
+def time_import(module: str) -> float:
+    """Import a module in a fresh interpreter and return the seconds it took"""
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; "
+        "print(time.perf_counter() - start)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=PROJECT_DIR, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url: str, timeout: float, status: int = 200) -> float:
+    """Poll a URL until it returns the expected status; return the time of success"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == status:
+                return time.monotonic()
+        except requests.RequestException:
+            pass
+        time.sleep(0.02)
+    raise TimeoutError(f"{url} did not return {status} within {timeout}s")
+
+
+def time_server_start(timeout: float):
+    """Start uvicorn and return (seconds to /health, seconds to /ready)"""
+    port = free_port()
+    start = time.monotonic()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend_enhanced:app", "--port", str(port), "--log-level", "warning"],
+        cwd=PROJECT_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        healthy = wait_for(f"http://127.0.0.1:{port}/health", timeout)
+        ready = wait_for(f"http://127.0.0.1:{port}/ready", timeout)
+        return healthy - start, ready - start
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def summarize(samples):
+    return f"median {statistics.median(samples) * 1000:8.1f} ms   min {min(samples) * 1000:8.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="repetitions per measurement")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for the server")
+    parser.add_argument("--skip-server", action="store_true", help="only measure imports")
+    args = parser.parse_args()
+
+    print(f"Startup benchmark ({args.runs} runs each)\n")
+
+    samples = [time_import("backend_enhanced") for _ in range(args.runs)]
+    print(f"{'import backend_enhanced':<44} {summarize(samples)}")
+
+    print("\nDeferred until first use:")
+    for module in DEFERRED_MODULES:
+        try:
+            samples = [time_import(module) for _ in range(args.runs)]
+            print(f"  {'import ' + module:<42} {summarize(samples)}")
+        except RuntimeError as e:
+            print(f"  {'import ' + module:<42} unavailable ({str(e).splitlines()[-1]})")
+
+    if not args.skip_server:
+        health_samples, ready_samples = [], []
+        for _ in range(args.runs):
+            healthy, ready = time_server_start(args.timeout)
+            health_samples.append(healthy)
+            ready_samples.append(ready)
+        print()
+        print(f"{'uvicorn start -> /health 200':<44} {summarize(health_samples)}")
+        print(f"{'uvicorn start -> /ready 200':<44} {summarize(ready_samples)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ load_dotenv()
 
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import uuid
 from datetime import datetime
@@ -186,6 +187,8 @@ if 'chat_history' not in st.session_state:
     st.session_state.chat_history = []
 if 'uploaded_documents' not in st.session_state:
     st.session_state.uploaded_documents = []
+if 'history_cursor' not in st.session_state:
+    st.session_state.history_cursor = 0
 
 # Professional header
 st.markdown("""
@@ -200,6 +203,47 @@ st.markdown("""
 
 # API Configuration
 API_URL = "https://agenticai-chatbot-using-rag.onrender.com"
+HISTORY_PAGE_SIZE = 100
+
+
+@st.cache_resource
+def get_http_client() -> requests.Session:
+    """Shared keep-alive HTTP client so reruns reuse pooled connections to the backend"""
+    client = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    client.mount("https://", adapter)
+    client.mount("http://", adapter)
+    return client
+
+
+http = get_http_client()
+
+
+def pair_history_messages(history, offset):
+    """Turn human/ai message pairs into chat entries; returns (entries, cursor after the last full pair)"""
+    entries = []
+    cursor = offset
+    i = 0
+    while i < len(history):
+        user_msg = history[i]
+        if user_msg.get('type') == 'human' and i + 1 < len(history):
+            ai_msg = history[i + 1]
+            if ai_msg.get('type') == 'ai':
+                entries.append({
+                    "timestamp": user_msg.get('timestamp', ''),
+                    "user": user_msg.get('content', ''),
+                    "assistant": ai_msg.get('content', ''),
+                    "session_id": st.session_state.session_id
+                })
+                i += 2
+                cursor = offset + i
+                continue
+        elif user_msg.get('type') == 'human':
+            # Unanswered message at the end of the page, pick it up next time
+            break
+        i += 1
+        cursor = offset + i
+    return entries, cursor
 
 # Sidebar Configuration
 with st.sidebar:
@@ -216,15 +260,17 @@ with st.sidebar:
         if st.button("🔄 New Session"):
             st.session_state.session_id = str(uuid.uuid4())
             st.session_state.chat_history = []
+            st.session_state.history_cursor = 0
             st.rerun()
 
     with col2:
         if st.button("🗑️ Clear History"):
             try:
-                response = requests.post(f"{API_URL}/clear-history",
-                                         json={"session_id": st.session_state.session_id})
+                response = http.post(f"{API_URL}/clear-history",
+                                     json={"session_id": st.session_state.session_id})
                 if response.status_code == 200:
                     st.session_state.chat_history = []
+                    st.session_state.history_cursor = 0
                     st.success("History cleared!")
                 else:
                     st.error("Failed to clear history")
@@ -248,14 +294,17 @@ with st.sidebar:
     # Agent Configuration
     st.subheader("🎯 Agent Settings")
     allow_web_search = st.checkbox("🔍 Allow Web Search", value=True)
-    similarity_threshold = st.slider(
-        "📊 RAG Similarity Threshold",
-        min_value=0.0,
-        max_value=1.0,
-        value=0.5,
-        step=0.1,
-        help="Higher values = more strict document matching"
-    )
+    # Without an override the backend uses the default for its embedding backend
+    similarity_threshold = None
+    if st.checkbox("📊 Custom RAG Similarity Threshold", value=False):
+        similarity_threshold = st.slider(
+            "RAG Similarity Threshold",
+            min_value=0.0,
+            max_value=1.0,
+            value=0.5,
+            step=0.01,
+            help="Higher values = more strict document matching (local embeddings score lower than Cohere)"
+        )
 
     # Document Management
     st.subheader("📚 Document Management")
@@ -269,7 +318,7 @@ with st.sidebar:
                 try:
                     files = {"file": (uploaded_file.name, uploaded_file.getvalue(), "application/pdf")}
                     data = {"user_id": st.session_state.user_id}
-                    response = requests.post(f"{API_URL}/upload-pdf", files=files, data=data)
+                    response = http.post(f"{API_URL}/upload-pdf", files=files, data=data)
 
                     if response.status_code == 200:
                         result = response.json()
@@ -281,10 +330,39 @@ with st.sidebar:
                 except Exception as e:
                     st.error(f"❌ Error uploading PDF: {str(e)}")
 
+    # Bulk upload: many PDFs and/or zip archives in one request
+    bulk_files = st.file_uploader("Bulk Upload PDFs / ZIP", type=['pdf', 'zip'], accept_multiple_files=True)
+
+    if bulk_files:
+        if st.button(f"📦 Process {len(bulk_files)} Files"):
+            with st.spinner("Processing files..."):
+                try:
+                    files = [("files", (f.name, f.getvalue(), f.type or "application/octet-stream"))
+                             for f in bulk_files]
+                    data = {"user_id": st.session_state.user_id}
+                    response = http.post(f"{API_URL}/upload-pdfs", files=files, data=data)
+
+                    if response.status_code == 200:
+                        result = response.json()
+                        st.success(f"✅ Indexed {result['indexed']} files ({result['chunks']} chunks)")
+                        for file_status in result["files"]:
+                            if file_status["status"] == "indexed":
+                                st.session_state.uploaded_documents.append(file_status["filename"])
+                            else:
+                                st.warning(f"⚠️ {file_status['filename']}: {file_status.get('error', file_status['status'])}")
+                    elif response.status_code == 429:
+                        retry_after = response.headers.get('Retry-After', 'a few')
+                        st.warning(f"⏳ Server is busy. Please retry in {retry_after} seconds.")
+                    else:
+                        error_detail = response.json().get('detail', 'Unknown error')
+                        st.error(f"❌ Upload failed: {error_detail}")
+                except Exception as e:
+                    st.error(f"❌ Error uploading files: {str(e)}")
+
     if st.button("📋 Refresh Documents"):
         try:
-            response = requests.post(f"{API_URL}/user-documents",
-                                     json={"user_id": st.session_state.user_id})
+            response = http.post(f"{API_URL}/user-documents",
+                                 json={"user_id": st.session_state.user_id})
             if response.status_code == 200:
                 result = response.json()
                 st.session_state.uploaded_documents = result.get('documents', [])
@@ -298,6 +376,12 @@ with st.sidebar:
     else:
         st.write("*No documents uploaded yet*")
 
+    selected_sources = st.multiselect(
+        "🎯 Answer only from:",
+        st.session_state.uploaded_documents,
+        help="Leave empty to search all of your documents"
+    )
+
 # Main Chat Interface
 col1, col2 = st.columns([2, 1])
 
@@ -330,11 +414,12 @@ with col1:
                     "allow_search": allow_web_search,
                     "user_id": st.session_state.user_id,
                     "session_id": st.session_state.session_id,
-                    "similarity_threshold": similarity_threshold
+                    "similarity_threshold": similarity_threshold,
+                    "sources": selected_sources or None
                 }
 
                 try:
-                    response = requests.post(f"{API_URL}/chat", json=payload)
+                    response = http.post(f"{API_URL}/chat", json=payload)
                     if response.status_code == 200:
                         data = response.json()
                         if "error" in data:
@@ -346,7 +431,13 @@ with col1:
                                 "assistant": data['response'],
                                 "session_id": data.get('session_id', st.session_state.session_id)
                             })
+                            st.session_state.history_cursor = data.get(
+                                'history_cursor', st.session_state.history_cursor
+                            )
                             st.rerun()
+                    elif response.status_code == 429:
+                        retry_after = response.headers.get('Retry-After', 'a few')
+                        st.warning(f"⏳ Server is busy. Please retry in {retry_after} seconds.")
                     else:
                         st.error("❌ Error: Could not get response from backend.")
                 except Exception as e:
@@ -359,24 +450,25 @@ with col2:
 
     if st.button("🔄 Load History"):
         try:
-            response = requests.post(f"{API_URL}/chat-history",
-                                     json={"session_id": st.session_state.session_id})
-            if response.status_code == 200:
+            # Only fetch turns added since the last load
+            has_more = True
+            while has_more:
+                response = http.post(f"{API_URL}/chat-history", json={
+                    "session_id": st.session_state.session_id,
+                    "cursor": st.session_state.history_cursor,
+                    "limit": HISTORY_PAGE_SIZE
+                })
+                if response.status_code != 200:
+                    break
+
                 result = response.json()
                 history = result.get('history', [])
-                st.session_state.chat_history = []
+                entries, cursor = pair_history_messages(history, st.session_state.history_cursor)
+                st.session_state.chat_history.extend(entries)
 
-                for i in range(0, len(history), 2):
-                    if i + 1 < len(history):
-                        user_msg = history[i]
-                        ai_msg = history[i + 1]
-                        if user_msg.get('type') == 'human' and ai_msg.get('type') == 'ai':
-                            st.session_state.chat_history.append({
-                                "timestamp": user_msg.get('timestamp', ''),
-                                "user": user_msg.get('content', ''),
-                                "assistant": ai_msg.get('content', ''),
-                                "session_id": st.session_state.session_id
-                            })
+                # Stop if no complete pair could be consumed from this page
+                has_more = result.get('has_more', False) and cursor > st.session_state.history_cursor
+                st.session_state.history_cursor = cursor
         except Exception as e:
             st.error(f"Error loading history: {str(e)}")
 
@@ -453,7 +545,8 @@ with col2:
             "selected_model": selected_model,
             "provider": provider,
             "similarity_threshold": similarity_threshold,
-            "allow_web_search": allow_web_search
+            "allow_web_search": allow_web_search,
+            "selected_sources": selected_sources
         })
 
 # Footer
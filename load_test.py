@@ -0,0 +1,387 @@
+"""Concurrent load-test harness for backend_enhanced.py.
+
+Starts the FastAPI app in-process with local stand-ins for every external
+provider (simulated LLM and web search latency, local hashing embeddings,
+synthetic PDF text) and drives /chat, /upload-pdf and /chat-history with a
+configurable mix of users and sessions. No network access is needed.
+
+Usage:
+    python load_test.py --users 20 --duration 30 --mix chat=0.8,upload=0.05,history=0.15
+    python load_test.py --url http://localhost:9999   # drive an already running server
+    python load_test.py --stress-locking --users 16   # concurrency stress test of the managers
+"""
+
+import argparse
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import uuid
+
+# Local stand-ins must be configured before the app modules are imported
+os.environ.setdefault("EMBEDDING_BACKEND", "local")
+os.environ.setdefault("WARM_UP_ON_STARTUP", "false")
+
+import requests
+
+SAMPLE_TOPICS = [
+    "quarterly revenue grew because of strong subscription sales",
+    "the onboarding guide explains how to configure single sign-on",
+    "photosynthesis converts sunlight into chemical energy in chloroplasts",
+    "the warranty covers manufacturing defects for two years",
+    "latency budgets are split between retrieval, reranking and generation",
+]
+
+
+def synthetic_document(paragraphs: int = 40) -> str:
+    """Text standing in for an extracted PDF"""
+    return "\n".join(
+        f"Section {i}. {random.choice(SAMPLE_TOPICS)}. " * 3 for i in range(paragraphs)
+    )
+
+
+class LatencyModel:
+    """Log-normal latency with a fixed median and an error probability"""
+
+    def __init__(self, median_ms: float, sigma: float, error_rate: float = 0.0):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+
+    def wait(self):
+        time.sleep(self.median_ms / 1000.0 * random.lognormvariate(0, self.sigma))
+        if random.random() < self.error_rate:
+            raise RuntimeError("Simulated provider error")
+
+
+def install_stand_ins(llm_latency: LatencyModel, search_latency: LatencyModel):
+    """Replace provider clients in ai_agent_enhanced with local simulations"""
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage, ToolMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+    from langchain_core.tools import BaseTool
+
+    import ai_agent_enhanced
+
+    class SimulatedChatModel(BaseChatModel):
+        """Answers directly, or searches once first when a search tool is bound"""
+        model_name: str = "simulated"
+        can_search: bool = False
+
+        @property
+        def _llm_type(self) -> str:
+            return "simulated"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            llm_latency.wait()
+            prompt_tokens = sum(len(str(m.content)) for m in messages) // 4
+            usage = {"input_tokens": prompt_tokens, "output_tokens": 50, "total_tokens": prompt_tokens + 50}
+            if self.can_search and not any(isinstance(m, ToolMessage) for m in messages):
+                # First step of a search-enabled turn: ask for a web search
+                message = AIMessage(content="", usage_metadata=usage, tool_calls=[{
+                    "name": "tavily_search", "args": {"query": str(messages[-1].content)[:80]},
+                    "id": f"call_{random.getrandbits(32):08x}",
+                }])
+            else:
+                message = AIMessage(content=f"Simulated answer to: {str(messages[-1].content)[:80]}",
+                                    usage_metadata=usage)
+            return ChatResult(generations=[ChatGeneration(message=message)])
+
+        def bind_tools(self, tools, tool_choice=None, **kwargs):
+            can_search = tool_choice != "none" and any(
+                getattr(tool, "name", None) == "tavily_search" for tool in tools
+            )
+            return self.model_copy(update={"can_search": can_search})
+
+    class SimulatedSearchTool(BaseTool):
+        name: str = "tavily_search"
+        description: str = "Simulated web search"
+
+        def _run(self, query: str = "", run_manager=None, **kwargs):
+            search_latency.wait()
+            return {"results": [
+                {"title": f"Result {i}", "url": f"https://example.com/{i}",
+                 "content": f"{random.choice(SAMPLE_TOPICS)} ({query})"}
+                for i in range(2)
+            ]}
+
+    chat_model = SimulatedChatModel()
+    search_tool = SimulatedSearchTool()
+    ai_agent_enhanced.provider_pool.get_llm = lambda provider, model: chat_model
+    ai_agent_enhanced.provider_pool.get_search_tool = lambda: search_tool
+    ai_agent_enhanced.extract_text_from_pdf = lambda pdf_file: synthetic_document()
+
+
+def start_server() -> str:
+    """Run the app with uvicorn on a background thread and return its base URL"""
+    import uvicorn
+    from backend_enhanced import app
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+class Recorder:
+    """Thread-safe collection of (endpoint, status, latency) samples"""
+
+    def __init__(self):
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def record(self, endpoint: str, status: int, latency: float):
+        with self.lock:
+            self.samples.append((endpoint, status, latency))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def parse_mix(mix: str):
+    weights = {}
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        weights[name.strip()] = float(weight)
+    unknown = set(weights) - {"chat", "upload", "history"}
+    if unknown:
+        raise ValueError(f"Unknown operations in mix: {', '.join(sorted(unknown))}")
+    return weights
+
+
+def virtual_user(base_url, user_index, args, weights, recorder, stop_at):
+    """One simulated user issuing requests back to back until the test ends"""
+    http = requests.Session()
+    user_id = f"load-user-{user_index % args.distinct_users}"
+    sessions = [str(uuid.uuid4()) for _ in range(args.sessions_per_user)]
+    operations, op_weights = zip(*weights.items())
+
+    while time.monotonic() < stop_at:
+        operation = random.choices(operations, op_weights)[0]
+        session_id = random.choice(sessions)
+        start = time.monotonic()
+        try:
+            if operation == "chat":
+                response = http.post(f"{base_url}/chat", json={
+                    "model_name": args.model,
+                    "model_provider": args.provider,
+                    "system_prompt": "You are a helpful assistant.",
+                    "messages": [f"Tell me about {random.choice(SAMPLE_TOPICS)}"],
+                    "allow_search": random.random() < args.search_ratio,
+                    "user_id": user_id,
+                    "session_id": session_id,
+                    "similarity_threshold": args.similarity_threshold,
+                }, timeout=args.request_timeout)
+            elif operation == "upload":
+                response = http.post(
+                    f"{base_url}/upload-pdf",
+                    data={"user_id": user_id},
+                    files={"file": (f"doc-{uuid.uuid4().hex[:8]}.pdf", b"%PDF-1.4 load test", "application/pdf")},
+                    timeout=args.request_timeout,
+                )
+            else:
+                response = http.post(f"{base_url}/chat-history", json={
+                    "session_id": session_id, "cursor": 0, "limit": 50
+                }, timeout=args.request_timeout)
+
+            status = response.status_code
+            if status == 200 and "error" in response.json():
+                status = 599  # endpoint reported an error in the body
+        except requests.RequestException:
+            status = 0
+        recorder.record(operation, status, time.monotonic() - start)
+
+        if args.think_time:
+            time.sleep(random.expovariate(1.0 / args.think_time))
+
+
+def print_report(recorder: Recorder, elapsed: float):
+    print(f"\n{'endpoint':<10} {'requests':>9} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'errors':>8} {'429s':>6}")
+    endpoints = sorted({s[0] for s in recorder.samples})
+    for endpoint in endpoints + ["all"]:
+        samples = [s for s in recorder.samples if endpoint == "all" or s[0] == endpoint]
+        latencies = sorted(s[2] for s in samples)
+        errors = sum(1 for s in samples if s[1] != 200 and s[1] != 429)
+        throttled = sum(1 for s in samples if s[1] == 429)
+        print(f"{endpoint:<10} {len(samples):>9} {len(samples) / elapsed:>8.1f} "
+              f"{percentile(latencies, 0.50) * 1000:>9.1f} {percentile(latencies, 0.95) * 1000:>9.1f} "
+              f"{percentile(latencies, 0.99) * 1000:>9.1f} {errors / max(len(samples), 1):>7.1%} "
+              f"{throttled:>6}")
+
+
+def stress_locking(args) -> bool:
+    """Hammer RAGManager and MemoryManager from many threads and check nothing was lost or corrupted"""
+    import ai_agent_enhanced
+
+    rag_manager = ai_agent_enhanced.RAGManager("local")
+    memory_manager = ai_agent_enhanced.MemoryManager()
+    user_ids = [f"stress-user-{i}" for i in range(args.distinct_users)]
+    documents = {user_id: [synthetic_document(20) for _ in range(args.stress_docs)] for user_id in user_ids}
+    expected_chunks = {
+        user_id: sum(len(rag_manager.text_splitter.split_text(doc)) for doc in docs)
+        for user_id, docs in documents.items()
+    }
+    # Odd users grow past the pooling threshold mid-run, so promotions race with pooled searches
+    rag_manager.pooled_max_chunks = min(expected_chunks.values()) // 2
+    for user_id in user_ids[::2]:
+        documents[user_id] = documents[user_id][:1]
+        expected_chunks[user_id] = len(rag_manager.text_splitter.split_text(documents[user_id][0]))
+    turns_per_thread = 200
+    errors = []
+    read_latencies = Recorder()
+    writers_done = threading.Event()
+
+    def writer(user_id, docs):
+        for i, doc in enumerate(docs):
+            if not rag_manager.process_pdf_content(user_id, doc, f"{user_id}-{i}.pdf"):
+                errors.append(f"ingestion failed for {user_id}")
+
+    def reader():
+        while not writers_done.is_set():
+            user_id = random.choice(user_ids)
+            if not rag_manager.has_documents(user_id):
+                time.sleep(0.001)
+                continue
+            start = time.monotonic()
+            try:
+                rag_manager.retrieve_relevant_docs(user_id, random.choice(SAMPLE_TOPICS))
+                rag_manager.calculate_similarity_score(user_id, random.choice(SAMPLE_TOPICS))
+            except Exception as e:
+                errors.append(f"search failed: {e}")
+            read_latencies.record("search", 200, time.monotonic() - start)
+
+    def chatter(thread_index):
+        for turn in range(turns_per_thread):
+            tag = f"{thread_index}-{turn}"
+            memory_manager.add_messages_to_session("shared-session", [
+                {"type": "human", "content": tag}, {"type": "ai", "content": tag}
+            ])
+
+    writers = [
+        threading.Thread(target=writer, args=(user_id, docs[half::2]))
+        for user_id, docs in documents.items() for half in (0, 1)
+    ]
+    others = [threading.Thread(target=reader) for _ in range(args.users)]
+    others += [threading.Thread(target=chatter, args=(i,)) for i in range(args.users)]
+
+    start = time.monotonic()
+    for thread in writers + others:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    writers_done.set()
+    for thread in others:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    # Every chunk must be in the index exactly once, with a matching docstore entry
+    for user_id, expected in expected_chunks.items():
+        store = rag_manager.vector_stores.get(user_id)
+        if store is not None:
+            sizes = (store.index.ntotal, len(store.index_to_docstore_id), len(store.docstore._dict))
+            if sizes != (expected,) * 3:
+                errors.append(f"{user_id}: expected {expected} chunks, index/mapping/docstore = {sizes}")
+            continue
+
+        # Pooled users: their positions must point at their own chunks in the shared store
+        store = rag_manager.pooled_store
+        positions = [p for ps in rag_manager.source_positions.get(user_id, {}).values() for p in ps]
+        owners = [store.docstore.search(store.index_to_docstore_id[int(p)]) for p in positions] if store else []
+        if len(positions) != expected or len(set(positions)) != expected:
+            errors.append(f"{user_id}: expected {expected} pooled chunks, found {len(set(positions))}")
+        elif any(getattr(doc, "metadata", {}).get("user_id") != user_id for doc in owners):
+            errors.append(f"{user_id}: pooled positions point at other users' chunks")
+    tiers = (len(rag_manager.vector_stores), len(user_ids) - len(rag_manager.vector_stores))
+
+    # Every turn must be stored once with its human and ai messages adjacent
+    history = memory_manager.get_session_history("shared-session")
+    if len(history) != 2 * turns_per_thread * args.users:
+        errors.append(f"memory: expected {2 * turns_per_thread * args.users} messages, got {len(history)}")
+    for human, ai in zip(history[::2], history[1::2]):
+        if human["type"] != "human" or ai["type"] != "ai" or human["content"] != ai["content"]:
+            errors.append(f"memory: interleaved turn {human['content']} / {ai['content']}")
+            break
+
+    latencies = sorted(s[2] for s in read_latencies.samples)
+    print(f"Stress test: {len(writers)} writers, {args.users} readers, {args.users} chat writers, {elapsed:.1f}s")
+    print(f"  searches: {len(latencies)}   p50 {percentile(latencies, 0.5) * 1000:.1f} ms   "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms")
+    print(f"  chunks indexed: {sum(expected_chunks.values())}   chat messages: {len(history)}   "
+          f"dedicated/pooled users: {tiers[0]}/{tiers[1]}")
+    for error in errors[:20]:
+        print(f"  ERROR {error}")
+    print("PASS" if not errors else f"FAIL ({len(errors)} errors)")
+    return not errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="target an already running server instead of the in-process app")
+    parser.add_argument("--users", type=int, default=10, help="concurrent virtual users")
+    parser.add_argument("--distinct-users", type=int, default=5, help="distinct user ids shared by virtual users")
+    parser.add_argument("--sessions-per-user", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=20, help="test length in seconds")
+    parser.add_argument("--mix", default="chat=0.8,upload=0.05,history=0.15",
+                        help="operation weights, e.g. chat=0.8,upload=0.05,history=0.15")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean pause between requests (s)")
+    parser.add_argument("--search-ratio", type=float, default=0.3, help="fraction of chats with web search")
+    parser.add_argument("--similarity-threshold", type=float, default=None,
+                        help="RAG similarity threshold (default: the embedding backend's)")
+    parser.add_argument("--model", default="llama-3.3-70b-versatile")
+    parser.add_argument("--provider", default="Groq")
+    parser.add_argument("--llm-latency-ms", type=float, default=800, help="median simulated LLM latency")
+    parser.add_argument("--llm-latency-sigma", type=float, default=0.5, help="log-normal spread of LLM latency")
+    parser.add_argument("--search-latency-ms", type=float, default=400, help="median simulated search latency")
+    parser.add_argument("--provider-error-rate", type=float, default=0.0)
+    parser.add_argument("--request-timeout", type=float, default=120)
+    parser.add_argument("--respect-quotas", action="store_true",
+                        help="keep the real provider rate limits instead of lifting them")
+    parser.add_argument("--stress-locking", action="store_true",
+                        help="run the multi-threaded ingestion/search/memory consistency test instead")
+    parser.add_argument("--stress-docs", type=int, default=10, help="documents per user in the stress test")
+    args = parser.parse_args()
+
+    if args.stress_locking:
+        sys.exit(0 if stress_locking(args) else 1)
+
+    weights = parse_mix(args.mix)
+    base_url = args.url
+    if not base_url:
+        if not args.respect_quotas:
+            for quota in ("GROQ_RPM", "OPENAI_RPM", "COHERE_RPM"):
+                os.environ.setdefault(quota, "1000000")
+        install_stand_ins(
+            LatencyModel(args.llm_latency_ms, args.llm_latency_sigma, args.provider_error_rate),
+            LatencyModel(args.search_latency_ms, 0.3, args.provider_error_rate),
+        )
+        base_url = start_server()
+
+    print(f"Driving {base_url} with {args.users} users for {args.duration:.0f}s, mix {weights}")
+    recorder = Recorder()
+    start = time.monotonic()
+    stop_at = start + args.duration
+    workers = [
+        threading.Thread(target=virtual_user, args=(base_url, i, args, weights, recorder, stop_at))
+        for i in range(args.users)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    print_report(recorder, time.monotonic() - start)
+
+
+if __name__ == "__main__":
+    main()